@@ -0,0 +1,61 @@
+"""Compare two sets of microbenchmark results and flag regressions.
+
+Usage::
+
+    $ pytest benchmarks --bench-json before.json
+    $ # ...make changes...
+    $ pytest benchmarks --bench-json after.json
+    $ python benchmarks/compare.py before.json after.json [--threshold 0.1]
+
+Exits with status 1 if any benchmark got slower by more than the threshold
+(a fraction: 0.1 means 10%).
+
+"""
+
+import argparse
+import json
+import sys
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('before')
+    parser.add_argument('after')
+    parser.add_argument('--threshold', type=float, default=0.1)
+    args = parser.parse_args()
+    before = load(args.before)
+    after = load(args.after)
+    regressions = compare(before, after, args.threshold)
+    if regressions:
+        print('\n%d regression(s) above %d%%: %s' %
+              (len(regressions), args.threshold * 100, ', '.join(regressions)))
+        sys.exit(1)
+
+
+def load(path):
+    with open(path) as f:
+        return {name: result['seconds']
+                for (name, result) in json.load(f)['results'].items()}
+
+
+def compare(before, after, threshold):
+    regressions = []
+    width = max(len(name) for name in set(before) | set(after))
+    for name in sorted(set(before) | set(after)):
+        if name not in before or name not in after:
+            print('%-*s  %s' % (width, name,
+                                'new' if name in after else 'removed'))
+            continue
+        change = after[name] / before[name] - 1
+        flag = ''
+        if change > threshold:
+            flag = '  REGRESSION'
+            regressions.append(name)
+        print('%-*s  %10.2f µs  %10.2f µs  %+7.1f%%%s' %
+              (width, name, before[name] * 1e6, after[name] * 1e6,
+               change * 100, flag))
+    return regressions
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+# A minimal microbenchmark harness on top of plain pytest,
+# so that no extra plugins are needed. Run with::
+#
+#     $ pytest benchmarks --bench-json results.json
+#
+# and compare two such files with ``benchmarks/compare.py``.
+
+import json
+import os
+import platform
+import sys
+import timeit
+
+import pytest
+
+import turq
+
+
+def pytest_addoption(parser):
+    group = parser.getgroup('benchmarks')
+    group.addoption('--bench-json', metavar='PATH',
+                    help='save benchmark results to PATH')
+    group.addoption('--bench-repeat', metavar='N', type=int, default=5,
+                    help='run each benchmark N times and keep the best')
+
+
+def pytest_configure(config):
+    config.bench_results = {}
+
+
+@pytest.fixture
+def bench(request):
+    # Call ``bench(func)`` to time `func()`. Each run makes enough calls
+    # to take at least 0.2 seconds; the fastest run is what counts,
+    # as the others are slowed down by noise.
+    config = request.config
+
+    def run(func):
+        timer = timeit.Timer(func)
+        (number, _) = timer.autorange()
+        runs = [total / number
+                for total in timer.repeat(config.getoption('bench_repeat'),
+                                          number)]
+        config.bench_results[request.node.name] = {
+            'seconds': min(runs),
+            'runs': runs,
+            'calls_per_run': number,
+        }
+        return min(runs)
+
+    return run
+
+
+def pytest_terminal_summary(terminalreporter, config):
+    results = config.bench_results
+    if not results:
+        return
+    terminalreporter.section('benchmarks')
+    width = max(len(name) for name in results)
+    for (name, result) in sorted(results.items()):
+        terminalreporter.write_line('%-*s  %10.2f µs' %
+                                    (width, name, result['seconds'] * 1e6))
+
+
+def pytest_sessionfinish(session):
+    config = session.config
+    path = config.getoption('bench_json')
+    if path and config.bench_results:
+        with open(path, 'w') as f:
+            json.dump({
+                'turq': turq.__version__,
+                'python': sys.version,
+                'platform': platform.platform(),
+                'cpus': os.cpu_count(),
+                # `False` on free-threaded Python, unless something
+                # turned the GIL back on.
+                'gil': getattr(sys, '_is_gil_enabled', lambda: True)(),
+                'results': config.bench_results,
+            }, f, indent=2, sort_keys=True)
+            f.write('\n')
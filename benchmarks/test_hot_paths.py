@@ -0,0 +1,143 @@
+# Microbenchmarks for the code that runs on every request.
+# See ``conftest.py`` for how to run them.
+
+# pylint: disable=protected-access,redefined-outer-name
+
+import concurrent.futures
+import socket
+import types
+
+import h11
+import pytest
+
+from turq.live import LiveFeed
+from turq.mock import MockHandler
+from turq.rules import (Request, Response, Rules, RulesContext,
+                        _decode_headers, _encode_headers)
+from turq.state import State
+import turq.util.http
+
+
+RAW_REQUEST_HEADERS = [
+    (b'host', b'example.com'),
+    (b'user-agent', b'Mozilla/5.0 (X11; Linux x86_64; rv:55.0) '
+                    b'Gecko/20100101 Firefox/55.0'),
+    (b'accept', b'text/html,application/xhtml+xml,application/xml;q=0.9,'
+                b'*/*;q=0.8'),
+    (b'accept-language', b'en-US,en;q=0.5'),
+    (b'accept-encoding', b'gzip, deflate'),
+    (b'cookie', b'session=0123456789abcdef; theme=dark'),
+    (b'connection', b'keep-alive'),
+]
+REQUEST_HEADERS = _decode_headers(RAW_REQUEST_HEADERS)
+
+RESPONSE_HEADERS = [
+    ('Content-Type', 'text/html; charset=utf-8'),
+    ('Cache-Control', 'no-cache'),
+    ('Set-Cookie', 'session=0123456789abcdef; Path=/; HttpOnly'),
+    ('X-Request-Id', '5f1d7c0e-2b9a-4c1e-9a57-3d2f7a0c9b11'),
+]
+
+
+def make_server(rules):
+    return types.SimpleNamespace(
+        compiled_rules=Rules(rules), throttle=None, tls_context=None,
+        recorder=None, capture=None, state=State(), watchdog=None,
+        live=LiveFeed())
+
+
+@pytest.fixture
+def context():
+    handler = types.SimpleNamespace(bucket=None, client_address=('::1', 0),
+                                    server=make_server('error(404)\n'))
+    context = RulesContext(handler.server.compiled_rules, handler)
+    context.request = Request(context, 'GET', '/products/123?format=json',
+                              '1.1', list(REQUEST_HEADERS))
+    context._response = Response()
+    context._scope = {}
+    return context
+
+
+def test_build_scope(bench, context):
+    bench(context._build_scope)
+
+
+def test_request_init(bench, context):
+    bench(lambda: Request(context, 'GET', '/products/123?format=json',
+                          '1.1', list(REQUEST_HEADERS)))
+
+
+def test_decode_headers(bench):
+    bench(lambda: _decode_headers(RAW_REQUEST_HEADERS))
+
+
+def test_encode_headers(bench):
+    bench(lambda: _encode_headers(RESPONSE_HEADERS))
+
+
+def test_route(bench, context):
+    bench(lambda: context.route('/products/:product_id'))
+
+
+def test_response_finalize(bench):
+    def finalize():
+        response = Response()
+        response.raw_headers.extend(RESPONSE_HEADERS)
+        response.finalize()
+    bench(finalize)
+
+
+def test_date(bench):
+    bench(turq.util.http.date)
+
+
+def test_gzip(bench, context):
+    body = b'<p>Lorem ipsum dolor sit amet, consectetur adipiscing.</p>\n' * 64
+
+    def compress():
+        context._response = Response()
+        context._response.body = body
+        context.gzip()
+    bench(compress)
+
+
+def round_trip(server, request):
+    # One complete request/response cycle through `MockHandler` and h11,
+    # over a local socket pair instead of TCP.
+    (ours, theirs) = socket.socketpair()
+    with ours, theirs:
+        theirs.sendall(request)
+        theirs.shutdown(socket.SHUT_WR)
+        MockHandler(ours, ('::1', 0), server)
+        ours.close()
+        while theirs.recv(65536):
+            pass
+
+
+REQUEST = h11.Connection(our_role=h11.CLIENT).send(h11.Request(
+    method='GET', target='/products/123', headers=RAW_REQUEST_HEADERS))
+
+
+@pytest.mark.parametrize('rules', ['error(404)\n', 'text("Hello world!")\n'],
+                         ids=['error', 'text'])
+def test_mock_handler_round_trip(bench, rules):
+    server = make_server(rules)
+    bench(lambda: round_trip(server, REQUEST))
+
+
+SCALING_ROUND_TRIPS = 64
+
+
+@pytest.mark.parametrize('threads', [1, 2, 4, 8])
+def test_round_trip_scaling(bench, threads):
+    # The same number of round trips, split between more and more threads.
+    # With the GIL, the time stays flat at best. On free-threaded Python,
+    # it should go down with the number of cores (up to `threads`).
+    server = make_server('state.incr("hits")\njson({"id": 123})\n')
+
+    def work(_):
+        for _ in range(SCALING_ROUND_TRIPS // threads):
+            round_trip(server, REQUEST)
+
+    with concurrent.futures.ThreadPoolExecutor(threads) as executor:
+        bench(lambda: list(executor.map(work, range(threads))))
@@ -0,0 +1,90 @@
+"""Measure the rate of TLS handshakes on the mock server.
+
+Starts Turq with the test certificate, then opens connections one after
+another, each doing a handshake and one request, first with full
+handshakes and then resuming the session of the previous connection.
+
+Usage::
+
+    $ python benchmarks/tls_handshake.py [--connections N]
+
+"""
+
+import argparse
+import json
+import os
+import shutil
+import socket
+import ssl
+import subprocess
+import sys
+import tempfile
+import time
+
+
+TESTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         os.pardir, 'tests')
+CERT_PATH = os.path.join(TESTS_DIR, 'localhost.pem')
+KEY_PATH = os.path.join(TESTS_DIR, 'localhost.key')
+REQUEST = b'GET / HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\n\r\n'
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--connections', type=int, default=500)
+    args = parser.parse_args()
+    # Any free port, as reported by Turq in its `--port-file`.
+    temp_dir = tempfile.mkdtemp()
+    port_file = os.path.join(temp_dir, 'ports.json')
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'turq.main', '--no-editor', '--no-color',
+         '--bind', 'localhost', '--mock-port', '0', '--port-file', port_file,
+         '--tls-cert', CERT_PATH, '--tls-key', KEY_PATH],
+        stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL)
+    try:
+        port = wait_for_server(process, port_file)
+        context = ssl.create_default_context(cafile=CERT_PATH)
+        for resume in [False, True]:
+            (rate, reused) = measure(context, port, args.connections, resume)
+            print('%-8s %8.1f handshakes/s  (%d%% resumed)' %
+                  ('resumed' if resume else 'full', rate,
+                   100 * reused / args.connections))
+    finally:
+        process.terminate()
+        process.wait()
+        shutil.rmtree(temp_dir)
+
+
+def wait_for_server(process, port_file, timeout=5):
+    # Turq writes the port file once it is accepting connections.
+    t0 = time.monotonic()
+    while time.monotonic() - t0 < timeout:
+        if os.path.exists(port_file):
+            with open(port_file) as f:
+                return json.load(f)['mock']
+        if process.poll() is not None:
+            break
+        time.sleep(0.01)
+    raise RuntimeError('Turq failed to start')
+
+
+def measure(context, port, n, resume):
+    session = None
+    reused = 0
+    t0 = time.perf_counter()
+    for _ in range(n):
+        sock = socket.create_connection(('localhost', port))
+        with context.wrap_socket(sock, server_hostname='localhost',
+                                 session=session) as tls_sock:
+            tls_sock.sendall(REQUEST)
+            while tls_sock.recv(4096):      # TLS 1.3 tickets arrive here
+                pass
+            reused += tls_sock.session_reused
+            if resume:
+                session = tls_sock.session
+    return (n / (time.perf_counter() - t0), reused)
+
+
+if __name__ == '__main__':
+    main()
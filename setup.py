@@ -32,9 +32,10 @@ setup(
         ],
     },
     entry_points={'console_scripts': ['turq=turq.main:main']},
+    python_requires='>= 3.7',
     install_requires=[
         'h11 >= 0.7.0',
-        'falcon >= 1.1.0',
+        'falcon >= 2.0.0',
         'dominate >= 2.3.1',
         'Werkzeug >= 0.12.1',
         'docutils >= 0.13.1',
@@ -50,9 +51,13 @@ setup(
         'Intended Audience :: Developers',
         'License :: OSI Approved :: ISC License (ISCL)',
         'Programming Language :: Python :: 3 :: Only',
-        'Programming Language :: Python :: 3.4',
-        'Programming Language :: Python :: 3.5',
-        'Programming Language :: Python :: 3.6',
+        'Programming Language :: Python :: 3.7',
+        'Programming Language :: Python :: 3.8',
+        'Programming Language :: Python :: 3.9',
+        'Programming Language :: Python :: 3.10',
+        'Programming Language :: Python :: 3.11',
+        'Programming Language :: Python :: 3.12',
+        'Programming Language :: Python :: 3.13',
         'Topic :: Internet :: WWW/HTTP :: HTTP Servers',
         'Topic :: Software Development :: Testing',
         'Topic :: Utilities',
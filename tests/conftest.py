@@ -1,6 +1,11 @@
+import json
+import os
+import shutil
+import signal
 import socket
 import subprocess
 import sys
+import tempfile
 import time
 
 import h11
@@ -19,15 +24,17 @@ class TurqInstance:
 
     def __init__(self):
         self.host = 'localhost'
-        # Test instance listens on port 13095 instead of the default 13085,
-        # to make it easier to run tests while also testing Turq manually.
-        # Of course, ideally it should be a random free port instead.
-        self.mock_port = 13095
-        self.editor_port = 13096
+        # Listen on any free ports, so that tests can run while Turq
+        # is also being tested manually (or in parallel with other tests).
+        # The actual ports are known once Turq writes its `--port-file`.
+        self.mock_port = 0
+        self.editor_port = 0
+        self.ports = None
         self.password = ''
         self.extra_args = []
         self.wait = True
         self._process = None
+        self._port_file = None
         self.console_output = None
 
     def __enter__(self):
@@ -36,6 +43,9 @@ class TurqInstance:
                 '--editor-port', str(self.editor_port)]
         if self.password is not None:
             args += ['--editor-password', self.password]
+        if self.wait:
+            self._port_file = os.path.join(tempfile.mkdtemp(), 'ports.json')
+            args += ['--port-file', self._port_file]
         args += self.extra_args
         self._process = subprocess.Popen(args, stdin=subprocess.DEVNULL,
                                          stdout=subprocess.DEVNULL,
@@ -45,23 +55,31 @@ class TurqInstance:
         return self
 
     def __exit__(self, exc_type, exc_value, traceback):
-        self._process.terminate()
-        self._process.wait()
-        self.console_output = self._process.stderr.read().decode()
+        # Rather than kill Turq, let it shut down as on Ctrl+C, finishing
+        # what it does after the response is sent (like logging or
+        # recording), and wait until it exits.
+        self._process.send_signal(signal.SIGINT)
+        (_, stderr) = self._process.communicate()
+        self.console_output = stderr.decode()
+        if self._port_file is not None:
+            shutil.rmtree(os.path.dirname(self._port_file))
+            self._port_file = None
         return False
 
-    def _wait_for_server(self, timeout=3):
-        # Wait until the mock server starts accepting connections,
+    def _wait_for_server(self, timeout=5):
+        # Wait until Turq reports that it is accepting connections,
         # but no more than `timeout` seconds.
         t0 = time.monotonic()
         while time.monotonic() - t0 < timeout:
-            time.sleep(0.1)
-            try:
-                self.connect().close()
-                self.connect_editor().close()
+            if os.path.exists(self._port_file):
+                with open(self._port_file) as f:
+                    self.ports = json.load(f)
+                self.mock_port = self.ports['mock']
+                self.editor_port = self.ports['editor']
                 return
-            except OSError:
-                pass
+            if self._process.poll() is not None:
+                break
+            time.sleep(0.01)
         raise RuntimeError('Turq failed to start')
 
     def connect(self):
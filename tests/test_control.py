@@ -1,7 +1,14 @@
 # pylint: disable=invalid-name
 
+import concurrent.futures
+import json
+import os
 import re
 import socket
+import ssl
+import subprocess
+import sys
+import threading
 import time
 
 import pytest
@@ -54,10 +61,10 @@ def test_editor(turq_instance):
 
 def test_no_editor(turq_instance):
     turq_instance.extra_args = ['--no-editor']
-    turq_instance.wait = False
-    with turq_instance, pytest.raises(requests.exceptions.ConnectionError):
-        time.sleep(1)
-        turq_instance.request_editor('GET', '/editor')
+    with turq_instance:
+        assert turq_instance.ports['editor'] is None
+        assert turq_instance.request('GET', '/').status_code == 404
+    assert 'editor' not in turq_instance.console_output
 
 
 def test_editor_bad_syntax(turq_instance):
@@ -69,6 +76,127 @@ def test_editor_bad_syntax(turq_instance):
         assert resp.text == 'unexpected EOF while parsing (<rules>, line 1)'
 
 
+def test_editor_bad_setup(turq_instance):
+    with turq_instance:
+        resp = turq_instance.request_editor(
+            'POST', '/editor',
+            data={'rules': 'if SETUP:\n    import nonexistent\n'})
+        assert resp.status_code == 422
+        assert resp.text == "error in setup, line 2: " \
+                            "No module named 'nonexistent'"
+
+
+def test_editor_forward_cache(turq_instance):
+    with turq_instance:
+        turq_instance.request_editor('POST', '/editor', data={
+            'rules': 'if path == "/upstream":\n'
+                     '    header("Cache-Control", "max-age=60")\n'
+                     '    text("Hello")\n'
+                     'else:\n'
+                     '    forward("localhost", %d, "/upstream", cache=True)\n'
+                     % turq_instance.ports['mock']})
+        for _ in range(4):
+            assert turq_instance.request('GET', '/').text == 'Hello'
+        resp = turq_instance.request_editor('GET', '/editor/cache')
+        assert 'hit: 3\n' in resp.text
+        assert 'miss: 1\n' in resp.text
+        assert 'hit ratio: 75.0%\n' in resp.text
+
+
+def test_concurrent_rules_and_installs(turq_instance):
+    # Requests run in parallel (truly so on free-threaded Python)
+    # while new rules are being installed. Every response must come
+    # entirely from one version of the rules, and no update is lost.
+    rules = ('state.incr("hits")\n'
+             'header("X-Version", "%(version)d")\n'
+             'if maybe(0.5):\n'
+             '    json({"version": %(version)d}, cache=True)\n'
+             'else:\n'
+             '    json({"version": %(version)d})\n')
+    done = threading.Event()
+
+    def install():
+        version = 0
+        while not done.is_set():
+            version += 1
+            resp = turq_instance.request_editor(
+                'POST', '/editor',
+                data={'rules': rules % {'version': version}})
+            assert resp.status_code == 200
+        return version
+
+    def client(_):
+        for _ in range(25):
+            resp = turq_instance.request('GET', '/')
+            assert resp.json()['version'] == int(resp.headers['X-Version'])
+
+    with turq_instance:
+        turq_instance.request_editor('POST', '/editor',
+                                     data={'rules': rules % {'version': 0}})
+        with concurrent.futures.ThreadPoolExecutor(9) as executor:
+            installs = executor.submit(install)
+            try:
+                list(executor.map(client, range(8)))
+            finally:
+                done.set()
+            assert installs.result() > 1
+        turq_instance.request_editor(
+            'POST', '/editor', data={'rules': 'text(str(state.get("hits")))'})
+        assert turq_instance.request('GET', '/').text == '200'
+
+
+def test_editor_live(turq_instance):
+    with turq_instance:
+        turq_instance.request_editor(
+            'POST', '/editor',
+            data={'rules': 'if path == "/missing": error(404)\n'
+                           'else: text("Hello")\n'})
+        resp = turq_instance.request_editor('GET', '/editor/live',
+                                            stream=True, timeout=5)
+        assert resp.headers['Content-Type'] == 'text/event-stream'
+        lines = resp.iter_lines(chunk_size=1, decode_unicode=True)
+        assert next(lines) == 'retry: 1000'
+        turq_instance.request('GET', '/hello')
+        turq_instance.request('POST', '/missing')
+        events = []
+        for line in lines:
+            if line.startswith('data: '):
+                events.append(json.loads(line[len('data: '):]))
+                if len(events) == 2:
+                    break
+        resp.close()
+        assert [(event['method'], event['target'], event['status'],
+                 event['response_body_size'], event['dropped'])
+                for event in events] == [('GET', '/hello', 200, 5, 0),
+                                         ('POST', '/missing', 404, 38, 0)]
+        assert 0 < events[0]['duration'] < 1
+
+
+def test_editor_memory(turq_instance):
+    with turq_instance:
+        resp = turq_instance.request_editor('GET', '/editor/memory')
+        assert re.search(r'^  RulesContext +0$', resp.text, re.MULTILINE)
+        assert re.search(r'^  threads +\d+$', resp.text, re.MULTILINE)
+        assert 'tracemalloc is not started.' in resp.text
+        resp = turq_instance.request_editor('POST', '/editor/memory',
+                                            data={'action': 'start'})
+        assert 'Top allocation sites:' in resp.text
+        turq_instance.request_editor('POST', '/editor/memory',
+                                     data={'action': 'snapshot'})
+        for _ in range(10):
+            turq_instance.request('GET', '/')
+        resp = turq_instance.request_editor('GET', '/editor/memory?limit=3')
+        [_, changes] = resp.text.split('Top changes since baseline:\n')
+        assert len(changes.splitlines()) == 3
+        resp = turq_instance.request_editor('POST', '/editor/memory',
+                                            data={'action': 'stop'})
+        assert 'tracemalloc is not started.' in resp.text
+        resp = turq_instance.request_editor('POST', '/editor/memory',
+                                            data={'action': 'snapshot'})
+        assert resp.status_code == 400
+        assert resp.text == 'tracemalloc is not started'
+
+
 def test_editor_bad_form(turq_instance):
     with turq_instance:
         resp = turq_instance.request_editor('POST', '/editor',
@@ -205,3 +333,337 @@ def test_editor_no_path_traversal(turq_instance, bad_path):
                      b'Host: example\r\n'
                      b'\r\n')
         assert b'HTTP/1.0 404 Not Found\r\n' in sock.recv(4096)
+
+
+def test_watch_rules(turq_instance, tmpdir):
+    rules_path = tmpdir.join('rules.py')
+    rules_path.write('text("Version 1")')
+    turq_instance.extra_args = ['--rules', str(rules_path), '--watch']
+    with turq_instance:
+        assert turq_instance.request('GET', '/').text == 'Version 1'
+        rules_path.write('text("Version 2")')
+        time.sleep(2)
+        assert turq_instance.request('GET', '/').text == 'Version 2'
+        rules_path.write('text("Version 3"')
+        time.sleep(2)
+        # Bad rules are not installed, the old ones keep working.
+        assert turq_instance.request('GET', '/').text == 'Version 2'
+    assert 'cannot reload rules from %s' % rules_path in \
+        turq_instance.console_output
+
+
+def test_listen(turq_instance, tmpdir):
+    tmpdir.join('users.py').write('text("users")')
+    tmpdir.join('orders.py').write('text("orders")')
+    turq_instance.extra_args = [
+        '--listen', '0=%s' % tmpdir.join('users.py'),
+        '-l', '0=%s' % tmpdir.join('orders.py'),
+    ]
+    with turq_instance:
+        [users_port, orders_port] = turq_instance.ports['listen']
+        url = 'http://%s:%%d/' % turq_instance.host
+        assert requests.get(url % users_port).text == 'users'
+        assert requests.get(url % orders_port).text == 'orders'
+        assert turq_instance.request('GET', '/').status_code == 404
+        resp = turq_instance.request_editor('GET', '/editor')
+        assert '>error(404)\n</textarea>' in resp.text
+        assert 'href="/editor?port=%d"' % orders_port in resp.text
+        resp = turq_instance.request_editor(
+            'POST', '/editor',
+            data={'rules': 'text("new orders")', 'port': str(orders_port)})
+        assert '>text(&quot;new orders&quot;)</textarea>' in resp.text
+        assert requests.get(url % orders_port).text == 'new orders'
+        assert requests.get(url % users_port).text == 'users'
+        resp = turq_instance.request_editor('GET', '/editor?port=1')
+        assert resp.status_code == 404
+    output = turq_instance.console_output
+    assert 'mock on port %d' % users_port in output
+    assert 'mock on port %d' % orders_port in output
+
+
+def test_listen_bad_spec(turq_instance):
+    turq_instance.extra_args = ['--listen', 'users.py']
+    turq_instance.wait = False
+    with turq_instance:
+        time.sleep(1)
+    assert 'expected PORT=PATH' in turq_instance.console_output
+
+
+def test_state(turq_instance):
+    with turq_instance:
+        turq_instance.request_editor(
+            'POST', '/editor',
+            data={'rules': 'state.set("token", "abc", ttl=60)\n'
+                           'text(str(state.incr("hits")))\n'})
+        with concurrent.futures.ThreadPoolExecutor(8) as executor:
+            list(executor.map(lambda _: turq_instance.request('GET', '/'),
+                              range(40)))
+        # New rules see the same state.
+        turq_instance.request_editor(
+            'POST', '/editor', data={'rules': 'text(str(state.get("hits")))'})
+        assert turq_instance.request('GET', '/').text == '40'
+        resp = turq_instance.request_editor('GET', '/editor/state')
+        assert "'hits' = 40\n" in resp.text
+        assert "'token' = 'abc'  (expires in " in resp.text
+
+
+def test_capture(turq_instance):
+    with turq_instance:
+        turq_instance.request_editor(
+            'POST', '/editor',
+            data={'rules': 'if path == "/missing": error(404)\n'
+                           'else: text("x" * 5000)\n'})
+        turq_instance.request('POST', '/api/users', data='Alice')
+        turq_instance.request('GET', '/missing')
+        turq_instance.request('GET', '/api/orders?page=2')
+        resp = turq_instance.request_editor('GET', '/requests')
+        assert resp.headers['Content-Type'] == 'application/json'
+        exchanges = resp.json()
+        assert [exchange['request']['target'] for exchange in exchanges] == \
+            ['/api/users', '/missing', '/api/orders?page=2']
+        [first, second, third] = exchanges
+        assert first['request']['body'] == 'Alice'
+        assert first['response']['status'] == 200
+        assert first['response']['body'] == 'x' * 1024
+        assert first['response']['body_size'] == 5000
+        assert ['Content-Type', 'text/plain; charset=utf-8'] in \
+            first['response']['headers']
+        resp = turq_instance.request_editor('GET', '/requests?status=4xx')
+        assert [e['id'] for e in resp.json()] == [second['id']]
+        resp = turq_instance.request_editor('GET', '/requests?path=/api/*')
+        assert [e['id'] for e in resp.json()] == [first['id'], third['id']]
+        resp = turq_instance.request_editor(
+            'GET', '/requests?since=%d' % second['id'])
+        assert [e['id'] for e in resp.json()] == [third['id']]
+
+
+def test_capture_limits(turq_instance):
+    turq_instance.extra_args = ['--capture', '2']
+    with turq_instance:
+        for i in range(5):
+            turq_instance.request('GET', '/%d' % i)
+        resp = turq_instance.request_editor('GET', '/requests')
+        assert [e['request']['target'] for e in resp.json()] == ['/3', '/4']
+    turq_instance.extra_args = ['--capture', '0']
+    with turq_instance:
+        turq_instance.request('GET', '/')
+        assert turq_instance.request_editor('GET', '/requests').status_code \
+            == 404
+
+
+def test_rules_cpu_limit(turq_instance):
+    turq_instance.extra_args = ['--rules-cpu-limit', '0.5']
+    with turq_instance:
+        turq_instance.request_editor(
+            'POST', '/editor',
+            data={'rules': 'if path == "/loop":\n'
+                           '    try:\n'
+                           '        while True: pass\n'
+                           '    except Exception:\n'
+                           '        pass\n'
+                           'text("Hello")\n'})
+        t0 = time.monotonic()
+        resp = turq_instance.request('GET', '/loop')
+        assert resp.status_code == 500
+        assert time.monotonic() - t0 < 3
+        # The server is still fine.
+        assert turq_instance.request('GET', '/').text == 'Hello'
+    assert 'error in rules, line 3: exceeded CPU time limit of 0.5 seconds' \
+        in turq_instance.console_output
+
+
+def test_rules_time_limit_after_headers(turq_instance):
+    turq_instance.extra_args = ['--rules-time-limit', '0.5']
+    with turq_instance:
+        turq_instance.request_editor(
+            'POST', '/editor',
+            data={'rules': 'chunk("Hello")\n'
+                           'for i in range(100): sleep(0.1)\n'})
+        with pytest.raises(requests.exceptions.ChunkedEncodingError):
+            turq_instance.request('GET', '/')
+    assert 'error in rules, line 2: exceeded time limit of 0.5 seconds' \
+        in turq_instance.console_output
+
+
+def test_port_file(turq_instance):
+    with turq_instance:
+        ports = turq_instance.ports
+        assert ports['mock'] not in [0, ports['editor']]
+        assert turq_instance.request('GET', '/').status_code == 404
+        assert turq_instance.request_editor('GET', '/editor').status_code \
+            == 200
+    assert 'mock on port %d' % ports['mock'] in turq_instance.console_output
+
+
+def test_ready_fd():
+    (read_fd, write_fd) = os.pipe()
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'turq.main', '--bind', 'localhost',
+         '--mock-port', '0', '--no-editor', '--ready-fd', str(write_fd)],
+        pass_fds=[write_fd], stderr=subprocess.DEVNULL)
+    try:
+        os.close(write_fd)
+        with os.fdopen(read_fd) as f:
+            ports = json.loads(f.readline())
+            assert f.read() == ''       # Closed after writing
+        assert ports['editor'] is None
+        resp = requests.get('http://localhost:%d/' % ports['mock'])
+        assert resp.status_code == 404
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def test_record_and_replay(turq_instance, tmpdir):
+    path = str(tmpdir.join('session.turq'))
+    turq_instance.extra_args = ['--record', path]
+    with turq_instance:
+        turq_instance.request_editor(
+            'POST', '/editor',
+            data={'rules': 'header("X-Foo", "bar")\n'
+                           'if request.body: text(request.body)\n'
+                           'else: text("Hello %s!" % query["name"])\n'})
+        turq_instance.request('GET', '/?name=Alice')
+        turq_instance.request('GET', '/?name=Bob')
+        turq_instance.request('POST', '/', data='Chunky')
+    turq_instance.extra_args = []
+    with turq_instance:
+        turq_instance.request_editor(
+            'POST', '/editor',
+            data={'rules': 'if not replay(%r): error(404)' % path})
+        resp = turq_instance.request('GET', '/?name=Alice')
+        assert resp.text == 'Hello Alice!'
+        assert resp.headers['X-Foo'] == 'bar'
+        assert turq_instance.request('GET', '/?name=Bob').text == 'Hello Bob!'
+        assert turq_instance.request('GET', '/?name=Carol').status_code == 404
+        assert turq_instance.request('POST', '/', data='Chunky').text == \
+            'Chunky'
+        assert turq_instance.request('POST', '/', data='Smooth').status_code \
+            == 404
+
+
+def test_serve_dir(turq_instance, tmpdir):
+    tmpdir.mkdir('fixtures').mkdir('products').join('123.json').write('{}')
+    tmpdir.join('secret.txt').write('Secret!')
+    root = str(tmpdir.join('fixtures'))
+    with turq_instance:
+        turq_instance.request_editor(
+            'POST', '/editor',
+            data={'rules': 'if not serve_dir(%r, prefix="/api/"):\n'
+                           '    error(404)\n' % root})
+        resp = turq_instance.request('GET', '/api/products/123.json')
+        assert resp.text == '{}'
+        assert resp.headers['Content-Type'] == 'application/json'
+        assert resp.headers['Content-Length'] == '2'
+        resp = turq_instance.request(
+            'GET', '/api/products/123.json',
+            headers={'If-None-Match': resp.headers['ETag']})
+        assert resp.status_code == 304
+        assert turq_instance.request('GET', '/api/products/456.json'). \
+            status_code == 404
+        assert turq_instance.request('GET', '/api/../secret.txt'). \
+            status_code == 404
+        assert turq_instance.request('GET', '/api/%2e%2e/secret.txt'). \
+            status_code == 404
+        assert turq_instance.request('GET', '/products/123.json'). \
+            status_code == 404
+        # Changes are picked up.
+        tmpdir.join('fixtures', 'products', '123.json').write('{"id": 123}')
+        tmpdir.join('fixtures', 'products', '456.json').write('{"id": 456}')
+        time.sleep(1)
+        assert turq_instance.request('GET', '/api/products/123.json'). \
+            json() == {'id': 123}
+        assert turq_instance.request('GET', '/api/products/456.json'). \
+            json() == {'id': 456}
+
+
+def test_serve_dir_prefix(turq_instance, tmpdir):
+    tmpdir.mkdir('products').join('123.json').write('{}')
+    tmpdir.join('x.json').write('{}')
+    with turq_instance:
+        turq_instance.request_editor(
+            'POST', '/editor',
+            data={'rules': 'if not serve_dir(%r, prefix="/api"):\n'
+                           '    error(404)\n' % str(tmpdir)})
+        assert turq_instance.request('GET', '/api/products/123.json'). \
+            text == '{}'
+        assert turq_instance.request('GET', '/api/x.json').status_code == 200
+        # The prefix must be followed by a slash.
+        assert turq_instance.request('GET', '/apix.json').status_code == 404
+        assert turq_instance.request('GET', '/api').status_code == 404
+
+
+def test_throttle(turq_instance):
+    turq_instance.extra_args = ['--throttle', '2000']
+    with turq_instance:
+        turq_instance.request_editor('POST', '/editor',
+                                     data={'rules': 'body("x" * 5000)'})
+        t0 = time.monotonic()
+        resp = turq_instance.request('GET', '/')
+        t1 = time.monotonic()
+    assert resp.content == b'x' * 5000
+    assert t1 - t0 >= 2
+
+
+TLS_CERT = os.path.join(os.path.dirname(__file__), 'localhost.pem')
+TLS_KEY = os.path.join(os.path.dirname(__file__), 'localhost.key')
+
+
+def test_tls(turq_instance):
+    turq_instance.extra_args = ['--tls-cert', TLS_CERT, '--tls-key', TLS_KEY]
+    with turq_instance:
+        url = 'https://localhost:%d/' % turq_instance.mock_port
+        resp = requests.get(url, verify=TLS_CERT)
+        assert resp.status_code == 404
+        # The editor knows about TLS, too.
+        assert 'https://127.0.0.1:%d/' % turq_instance.mock_port in \
+            turq_instance.request_editor('GET', '/editor').text
+        # Sessions can be resumed.
+        context = ssl.create_default_context(cafile=TLS_CERT)
+        context.set_alpn_protocols(['h2', 'http/1.1'])
+        session = None
+        for _ in range(2):
+            with context.wrap_socket(turq_instance.connect(),
+                                     server_hostname='localhost',
+                                     session=session) as sock:
+                assert sock.selected_alpn_protocol() == 'http/1.1'
+                sock.sendall(b'GET / HTTP/1.1\r\n'
+                             b'Host: example\r\n'
+                             b'Connection: close\r\n'
+                             b'\r\n')
+                while sock.recv(4096):
+                    pass
+                reused = sock.session_reused
+                session = sock.session
+        assert reused
+        # Plain HTTP clients don't disturb the server.
+        with turq_instance.connect() as sock:
+            sock.sendall(b'GET / HTTP/1.1\r\n\r\n')
+            try:
+                sock.recv(4096)
+            except ConnectionResetError:
+                pass
+        assert requests.get(url, verify=TLS_CERT).status_code == 404
+    assert 'mock on port %d - try https://' % turq_instance.mock_port in \
+        turq_instance.console_output
+    assert 'TLS handshake failed' in turq_instance.console_output
+
+
+@pytest.mark.parametrize('code', [
+    'import turq.main',
+    'import turq.main; turq.main.parse_args(["turq", "--no-editor"])',
+    'import turq.main, turq.mock, turq.rules',
+])
+def test_startup_imports(code):
+    # Heavy dependencies must only be imported when they are actually used,
+    # because Turq is often started many times in a row (e.g. by test suites).
+    output = subprocess.check_output([sys.executable, '-X', 'importtime',
+                                      '-c', code],
+                                     stderr=subprocess.STDOUT).decode()
+    imported = {line.split('|')[-1].strip()
+                for line in output.splitlines()
+                if line.startswith('import time:')}
+    assert 'turq.main' in imported
+    for heavy in ['falcon', 'werkzeug', 'docutils', 'dominate', 'colorlog',
+                  'turq.editor']:
+        assert heavy not in imported
@@ -0,0 +1,410 @@
+# Test running Turq inside the test process with `turq.serve`.
+
+import concurrent.futures
+import hashlib
+import os
+import socket
+import threading
+import time
+import tracemalloc
+
+import pytest
+import requests
+
+import turq
+from turq.cache import ForwardCache
+from turq.mock import MockServer, SocketOptions
+from turq.recording import Recorder, Recording, open_recording
+from turq.static import DirectoryIndex
+from turq.util.singleflight import SingleFlight
+
+
+def test_serve():
+    t0 = time.monotonic()
+    with turq.serve('text("Hello world!")') as server:
+        resp = requests.get(server.url + '/')
+        assert time.monotonic() - t0 < 1
+        assert resp.text == 'Hello world!'
+        assert server.url == 'http://127.0.0.1:%d' % server.port
+        server.install_rules('error(404)')
+        assert requests.get(server.url + '/').status_code == 404
+    with pytest.raises(requests.exceptions.ConnectionError):
+        requests.get(server.url + '/')
+
+
+def test_serve_many():
+    servers = [turq.serve('text("%d")' % i) for i in range(10)]
+    try:
+        assert len({server.port for server in servers}) == 10
+        for (i, server) in enumerate(servers):
+            assert requests.get(server.url + '/').text == str(i)
+    finally:
+        for server in servers:
+            server.close()
+
+
+def test_serve_options():
+    with turq.serve('text("x" * 2000)', throttle=10000) as server:
+        t0 = time.monotonic()
+        requests.get(server.url + '/')
+        assert time.monotonic() - t0 > 0.1
+
+
+def test_serve_bad_rules():
+    with pytest.raises(SyntaxError):
+        turq.serve('text(')
+
+
+def test_burst_of_connections():
+    # With a small listen backlog, some of these would be dropped
+    # and retried by the client only after a second or more.
+    def connect_and_request(_):
+        with socket.create_connection(('localhost', server.port)) as sock:
+            sock.sendall(b'GET / HTTP/1.0\r\n\r\n')
+            with sock.makefile('rb') as f:
+                response = f.read()
+        return response.startswith(b'HTTP/1.1 200 OK')
+
+    with turq.serve('text("Hello")') as server:
+        t0 = time.monotonic()
+        with concurrent.futures.ThreadPoolExecutor(200) as executor:
+            assert all(executor.map(connect_and_request, range(400)))
+        assert time.monotonic() - t0 < 1
+
+
+@pytest.mark.skipif(not hasattr(socket, 'TCP_DEFER_ACCEPT'),
+                    reason='Linux only')
+def test_socket_options():
+    options = SocketOptions(backlog=64, nodelay=False, defer_accept=1,
+                            fastopen=None, sndbuf=None, rcvbuf=131072)
+    with turq.serve('text("Hello")', socket_options=options) as server:
+        sock = server.socket
+        assert sock.getsockopt(socket.IPPROTO_TCP,
+                               socket.TCP_DEFER_ACCEPT) >= 1
+        assert sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF) >= 131072
+        assert requests.get(server.url + '/').text == 'Hello'
+
+
+def test_accepted_connections():
+    server = MockServer('localhost', 0, False, 'text("Hello")')
+    address = ('localhost', server.port)
+    with server, socket.create_connection(address), \
+            socket.create_connection(address) as dropped, \
+            socket.create_connection(address) as client:
+        time.sleep(0.1)
+        # Accepted sockets are blocking, even though the listening one isn't.
+        (sock, _) = server.get_request()
+        with sock:
+            assert sock.getblocking()
+
+        # A connection that can't be set up is dropped, but the rest
+        # of the pending ones are still accepted.
+        def fail_once(_):
+            server.set_up_connection = lambda _: None
+            raise ConnectionResetError()
+        server.set_up_connection = fail_once
+        client.sendall(b'GET / HTTP/1.0\r\n\r\n')
+        client.settimeout(2)
+        server._handle_request_noblock()    # pylint: disable=protected-access
+        assert dropped.recv(1) == b''
+        with client.makefile('rb') as f:
+            assert f.read().endswith(b'Hello')
+
+
+UPSTREAM_RULES = '''
+hits = state.incr(path)
+if path == '/validated' and request.headers.get('If-None-Match') == '"v1"':
+    status(304)
+else:
+    if path == '/fresh':
+        header('Cache-Control', 'max-age=60')
+    elif path == '/validated':
+        header('Cache-Control', 'no-cache')
+        header('ETag', '"v1"')
+    elif path == '/stale':
+        header('Cache-Control', 'max-age=0, stale-while-revalidate=60')
+        header('ETag', '"v%d"' % hits)
+    elif path == '/vary':
+        header('Cache-Control', 'max-age=60')
+        header('Vary', 'Accept-Language')
+    elif path == '/private':
+        header('Cache-Control', 'private, max-age=60')
+    text('%s %d' % (request.headers.get('Accept-Language'), hits))
+'''
+
+
+def test_wait_for_exchanges():
+    with turq.serve('sleep(0.2); text("done")') as server:
+        assert server.wait_for_exchanges(0)
+        with concurrent.futures.ThreadPoolExecutor(1) as executor:
+            future = executor.submit(requests.get, server.url)
+            time.sleep(0.1)
+            assert not server.wait_for_exchanges(0)
+            assert server.wait_for_exchanges(5)
+            assert future.result().text == 'done'
+
+
+def test_forward_cache():
+    with turq.serve(UPSTREAM_RULES) as upstream, \
+            turq.serve('forward("127.0.0.1", %d, target, cache=True)'
+                       % upstream.port) as server:
+        def get(path, **kwargs):
+            return requests.get(server.url + path, **kwargs)
+
+        assert get('/fresh').text == 'None 1'
+        resp = get('/fresh')
+        assert resp.text == 'None 1'
+        assert 'Age' in resp.headers
+        assert get('/validated').text == 'None 1'
+        assert get('/validated').text == 'None 1'
+        assert upstream.state.get('/validated') == 2
+        for language in ['en', 'de', 'en']:
+            resp = get('/vary', headers={'Accept-Language': language})
+        assert resp.text == 'en 1'
+        assert get('/private').text == 'None 1'
+        assert get('/private').text == 'None 2'
+        # Request ``Cache-Control`` is honored.
+        resp = get('/fresh', headers={'Cache-Control': 'no-cache'})
+        assert resp.text == 'None 2'
+        # Unsafe methods invalidate the cache.
+        requests.post(server.url + '/fresh')
+        assert get('/fresh').text == 'None 4'
+        stats = server.forward_cache.stats()
+        assert (stats['hit'], stats['revalidated'], stats['bypass']) == \
+            (2, 1, 1)
+        assert 0 < stats['hit_ratio'] < 1
+
+
+def test_forward_cache_stale_while_revalidate():
+    with turq.serve(UPSTREAM_RULES) as upstream, \
+            turq.serve('forward("127.0.0.1", %d, target, cache=True)'
+                       % upstream.port) as server:
+        assert requests.get(server.url + '/stale').text == 'None 1'
+        # Served stale without waiting, and revalidated in the background.
+        assert requests.get(server.url + '/stale').text == 'None 1'
+        time.sleep(0.2)
+        assert upstream.state.get('/stale') == 2
+        assert requests.get(server.url + '/stale').text == 'None 2'
+
+
+def test_forward_cache_size():
+    cache = ForwardCache(max_bytes=1500)
+    with turq.serve(UPSTREAM_RULES) as upstream, \
+            turq.serve('forward("127.0.0.1", %d, target, cache=True)'
+                       % upstream.port, forward_cache=cache) as server:
+        for path in ['/fresh', '/vary', '/fresh', '/validated', '/vary']:
+            requests.get(server.url + path)
+        assert cache.stats()['bytes'] <= 1500
+        # ``/vary`` was evicted as the least recently used.
+        assert cache.stats()['hit'] == 1
+        assert upstream.state.get('/vary') == 2
+
+
+SLOW_UPSTREAM_RULES = '''
+state.incr(path)
+sleep(0.5)
+if path == '/broken':
+    send_raw('garbage\\r\\n\\r\\n')
+else:
+    text('Hello %s' % request.headers.get('Accept-Language'))
+'''
+
+
+def test_forward_coalesce():
+    def get(path, language='en'):
+        resp = requests.get(server.url + path,
+                            headers={'Accept-Language': language})
+        return (resp.status_code, resp.text, resp.headers.get('X-Mine'))
+
+    with turq.serve(SLOW_UPSTREAM_RULES) as upstream, \
+            turq.serve('forward("127.0.0.1", %d, target, coalesce=True)\n'
+                       'add_header("X-Mine", "1")\n'
+                       % upstream.port) as server:
+        with concurrent.futures.ThreadPoolExecutor(10) as executor:
+            results = list(executor.map(get, ['/'] * 8 + ['/other'] * 2))
+            # Each request's rules changed its own copy of the response.
+            assert results == [(200, 'Hello en', '1')] * 10
+            assert (upstream.state.get('/'), upstream.state.get('/other')) \
+                == (1, 1)
+            # Different selected headers are not coalesced.
+            results = list(executor.map(get, ['/'] * 4, ['en', 'de'] * 2))
+            assert upstream.state.get('/') == 3
+            # An upstream error goes to all coalesced requests.
+            results = list(executor.map(get, ['/broken'] * 4))
+            assert [status for (status, _, _) in results] == [500] * 4
+            assert upstream.state.get('/broken') == 1
+
+
+def test_forward_coalesce_wait_limit():
+    with turq.serve(SLOW_UPSTREAM_RULES) as upstream, \
+            turq.serve('forward("127.0.0.1", %d, target, coalesce=True)'
+                       % upstream.port,
+                       single_flight=SingleFlight(wait_limit=0.1)) as server:
+        with concurrent.futures.ThreadPoolExecutor(4) as executor:
+            t0 = time.monotonic()
+            statuses = sorted(
+                executor.map(lambda _: requests.get(server.url).status_code,
+                             range(4)))
+            assert statuses == [200, 500, 500, 500]
+            assert time.monotonic() - t0 < 1
+
+
+def test_single_flight_interrupted_leader():
+    class Interrupted(BaseException):
+        pass
+
+    def lead():
+        started.set()
+        release.wait()
+        raise Interrupted()
+
+    single_flight = SingleFlight(wait_limit=5)
+    (started, release) = (threading.Event(), threading.Event())
+    with concurrent.futures.ThreadPoolExecutor(2) as executor:
+        leader = executor.submit(single_flight.run, 'key', lead)
+        started.wait()
+        waiter = executor.submit(single_flight.run, 'key', lambda: 'retried')
+        time.sleep(0.1)                 # Let it start waiting
+        release.set()
+        with pytest.raises(Interrupted):
+            leader.result()
+        # The waiter didn't get the interruption, but became the new leader.
+        assert waiter.result() == ('retried', False)
+
+
+def test_directory_index_scans_once(tmpdir, monkeypatch):
+    def slow_walk(*args):
+        walks.append(args)
+        time.sleep(0.1)
+        return os_walk(*args)
+
+    tmpdir.join('hello.txt').write('Hello')
+    index = DirectoryIndex(str(tmpdir))
+    index.scan()
+    index.rescan_interval = 0
+    (walks, os_walk) = ([], os.walk)
+    monkeypatch.setattr(os, 'walk', slow_walk)
+    with concurrent.futures.ThreadPoolExecutor(8) as executor:
+        # Concurrent lookups of missing paths cause only one rescan.
+        found = list(executor.map(index.open, ['hello.txt', 'missing'] * 4))
+    assert [bool(result) for result in found] == [True, False] * 4
+    assert len(walks) == 1
+
+
+def test_live_feed_drops_oldest():
+    with turq.serve('text("Hello")') as server:
+        subscriber = server.live.subscribe(queue_size=3)
+        for i in range(5):
+            requests.get(server.url + '/%d' % i)
+        time.sleep(0.1)     # Published after the response is sent
+        (summaries, dropped) = subscriber.get(timeout=1)
+        assert [summary.target for summary in summaries] == ['/2', '/3', '/4']
+        assert dropped == 2
+        server.live.unsubscribe(subscriber)
+
+
+def test_record_big_body(tmpdir):
+    # The body goes to the recording without being held in memory.
+    path = str(tmpdir.join('session.turq'))
+    size = 50 * 1024**2
+    recorder = Recorder(path)
+    with turq.serve('random_body(%d)' % size, recorder=recorder) as server:
+        tracemalloc.start()
+        try:
+            with requests.get(server.url + '/', stream=True) as resp:
+                for _ in resp.iter_content(65536):
+                    pass
+            time.sleep(0.2)         # Recorded after the response is sent
+            (_, peak) = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+    recorder.close()
+    assert peak < 10 * 1024**2
+    (status_code, _, _, body) = Recording(path).lookup('GET', '/', [],
+                                                       hashlib.sha1().digest())
+    assert (status_code, len(body)) == (200, size)
+
+
+def test_replay_reopens_changed_recording(tmpdir):
+    path = str(tmpdir.join('session.turq'))
+    recorder = Recorder(path)
+    with turq.serve('text(path)', recorder=recorder) as recording, \
+            turq.serve('if not replay(%r): error(404)' % path) as replaying:
+        requests.get(recording.url + '/one')
+        time.sleep(0.1)
+        assert requests.get(replaying.url + '/one').text == '/one'
+        assert requests.get(replaying.url + '/two').status_code == 404
+        requests.get(recording.url + '/two')
+        time.sleep(0.1)
+        assert requests.get(replaying.url + '/two').text == '/two'
+    recorder.close()
+
+
+def test_replay_indexes_appended_records(tmpdir):
+    (path, other_path) = (str(tmpdir.join('a.turq')), str(tmpdir.join('b')))
+    (recorder, other_recorder) = (Recorder(path), Recorder(other_path))
+    with turq.serve('text(path)', recorder=recorder) as server, \
+            turq.serve('text(path)', recorder=other_recorder) as other:
+        requests.get(server.url + '/one')
+        time.sleep(0.1)                 # Recorded after the response is sent
+        recording = open_recording(path)
+        assert len(recording) == 1
+        requests.get(server.url + '/two')
+        requests.get(server.url + '/three')
+        time.sleep(0.1)
+        # The same recording, with only the new records indexed.
+        assert open_recording(path) is recording
+        assert len(recording) == 3
+        (_, _, _, body) = recording.lookup('GET', '/three', [],
+                                           hashlib.sha1().digest())
+        assert bytes(body) == b'/three'
+        # A different file at the same path is indexed anew.
+        requests.get(other.url + '/four')
+        time.sleep(0.1)
+        os.replace(other_path, path)
+        replaced = open_recording(path)
+        assert replaced is not recording
+        assert len(replaced) == 1
+    recorder.close()
+    other_recorder.close()
+
+
+def test_body_rejects_objects(caplog):
+    with turq.serve('body({"a": 1})') as server:
+        assert requests.get(server.url + '/').status_code == 500
+        assert '(use json() to send objects as JSON)' in caplog.text
+        server.install_rules('body([b"a", 1])')
+        assert requests.get(server.url + '/').status_code == 500
+        assert 'got a piece of type int' in caplog.text
+        server.install_rules('body(42)')
+        assert requests.get(server.url + '/').status_code == 500
+        server.install_rules('body([b"a", "b"])')
+        assert requests.get(server.url + '/').text == 'ab'
+
+
+def test_gzip_generated_body():
+    rules = ('if path == "/random": random_body(100000, seed=1)\n'
+             'else: body(str(i).encode() for i in range(1000))\n'
+             'gzip()\n')
+    with turq.serve(rules) as server:
+        resp = requests.get(server.url + '/random')
+        assert resp.headers['Content-Encoding'] == 'gzip'
+        assert 'Content-Length' not in resp.headers
+        assert len(resp.content) == 100000
+        resp = requests.get(server.url + '/generator')
+        assert resp.content == b''.join(str(i).encode() for i in range(1000))
+
+
+def test_generated_body_errors(caplog):
+    with turq.serve('body(iter([b"x"])); content_length()') as server:
+        assert requests.get(server.url + '/').status_code == 500
+        assert 'content_length() cannot be used' in caplog.text
+        server.install_rules('random_body(-5)')
+        assert requests.get(server.url + '/').status_code == 500
+        assert 'body size cannot be negative' in caplog.text
+        # Not a truncated response, but an error before it starts.
+        server.install_rules('repeat_body("", 10)')
+        assert requests.get(server.url + '/').status_code == 500
+        assert 'cannot repeat an empty pattern' in caplog.text
+        server.install_rules('random_body(1.5)')
+        assert requests.get(server.url + '/').status_code == 500
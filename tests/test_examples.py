@@ -4,9 +4,11 @@
 
 # pylint: disable=redefined-outer-name,invalid-name
 
+import hashlib
 import json
 import io
 import os
+import threading
 import time
 
 import h11
@@ -103,6 +105,45 @@ def test_custom_status_code_and_reason_1(example):
     assert resp.reason == b'Server Fell Over'
 
 
+def test_delays_1(example):
+    t0 = time.monotonic()
+    resp = example.request('GET', '/')
+    t1 = time.monotonic()
+    assert t1 - t0 >= 2
+    assert resp.text == 'Sorry for the wait!\r\n'
+
+
+def test_delays_2(example):
+    t0 = time.monotonic()
+    resp = example.request('GET', '/')
+    t1 = time.monotonic()
+    assert t1 - t0 < 30
+    assert resp.text == 'Mostly fast, sometimes slow\r\n'
+
+
+def test_slow_connections_1(example):
+    t0 = time.monotonic()
+    resp = example.request('GET', '/')
+    t1 = time.monotonic()
+    # The first 25 bytes (50 ms worth) can be sent without waiting.
+    assert t1 - t0 >= (len(resp.content) - 25) / 500
+    assert resp.text.endswith('.')
+
+
+def test_slow_connections_2(example):
+    lengths = []
+    def get():
+        lengths.append(len(example.request('GET', '/').content))
+    threads = [threading.Thread(target=get) for _ in range(2)]
+    t0 = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    t1 = time.monotonic()
+    assert t1 - t0 >= (sum(lengths) - 25) / 500
+
+
 def test_response_framing_1_content_length(example):
     resp, data, _ = example.send(h11.Request(method='GET', target='/',
                                              headers=[('Host', 'example')]),
@@ -165,6 +206,37 @@ def test_streaming_responses_2(example):
     assert b'content-md5' in dict(end.headers)      # In the trailer part
 
 
+def test_streaming_responses_3(example):
+    resp = example.request('GET', '/')
+    assert resp.headers['Content-Type'] == 'text/csv'
+    assert resp.headers['Transfer-Encoding'] == 'chunked'
+    lines = resp.text.splitlines()
+    assert lines[:3] == ['0,0', '1,1', '2,4']
+    assert len(lines) == 1000
+    resp = example.request('HEAD', '/')
+    assert resp.content == b''
+
+
+def test_streaming_responses_4(example):
+    with example.connect() as sock:
+        sock.sendall(b'GET / HTTP/1.1\r\n'
+                     b'Host: example\r\n'
+                     b'Connection: close\r\n'
+                     b'\r\n')
+        with sock.makefile('rb') as f:
+            raw = f.read()
+    (_, body) = raw.split(b'\r\n\r\n', 1)
+    chunks = []
+    while True:
+        (size, body) = body.split(b'\r\n', 1)
+        if int(size, 16) == 0:
+            break
+        chunks.append(body[:int(size, 16)])
+        body = body[int(size, 16) + 2:]
+    assert b''.join(chunks).splitlines()[-1] == b'99999,9999800001'
+    assert all(len(chunk) >= 16 * 1024 for chunk in chunks[:-1])
+
+
 def test_handling_expect_100_continue_1(example):
     with example.connect() as sock:
         sock.sendall(b'POST / HTTP/1.1\r\n'
@@ -241,6 +313,15 @@ def test_request_details_1_raw(example):
     assert resp.text == 'Hello Ramesses!\r\n'
 
 
+def test_request_details_2(example):
+    resp = example.request('POST', '/',
+                           files={'upload': ('data.bin',
+                                             io.BytesIO(b'\x00\xff' * 999999),
+                                             'application/octet-stream')})
+    assert resp.text == \
+        'Got data.bin (application/octet-stream), 1999998 bytes\r\n'
+
+
 def test_restful_routing_1_hit(example):
     resp = example.request('GET', '/v1/products/12345')
     assert resp.json() == {'id': 12345, 'inStock': True}
@@ -292,6 +373,31 @@ def test_random_responses_1(example):
     assert resp.status_code == 503 or 'Hello world!' in resp.text
 
 
+def test_stateful_mocks_1(example):
+    for _ in range(3):
+        assert example.request('GET', '/').status_code == 503
+    assert example.request('GET', '/').text == 'Finally!\r\n'
+
+
+def test_stateful_mocks_2(example):
+    for _ in range(5):
+        assert example.request('GET', '/').status_code == 200
+    assert example.request('GET', '/').status_code == 429
+
+
+def test_setup_code_1(example):
+    resp = example.request('GET', '/', params={'n': '5'})
+    assert resp.text == hashlib.sha256(b'5').hexdigest()
+    assert example.request('GET', '/', params={'n': 'x'}).text == 'unknown'
+
+
+def test_setup_code_2(example):
+    resp = example.request('GET', '/users/1')
+    assert resp.status_code == 404
+    assert resp.headers['X-Missing'] == 'user'
+    assert resp.json() == {'error': 'user not found'}
+
+
 def test_switching_protocols_1_upgrade(example):
     with example.connect() as sock:
         sock.sendall(b'GET / HTTP/1.1\r\n'
@@ -346,6 +452,34 @@ def test_cross_origin_resource_sharing_2_callback(example):
     assert resp.text == '__jsonp4321({"some": "data"});'
 
 
+def test_cross_origin_resource_sharing_3_callback(example):
+    resp = example.request('GET', '/', params={'callback': '__jsonp4321'})
+    assert resp.headers['Content-Type'] == 'application/javascript'
+    assert resp.text == '__jsonp4321({"some": "data"});'
+    resp = example.request('GET', '/')
+    assert resp.json() == {'some': 'data'}
+
+
+def test_big_json_responses_1(example):
+    resp = example.request('GET', '/')
+    assert resp.headers['Content-Type'] == 'application/json'
+    assert resp.headers['Transfer-Encoding'] == 'chunked'
+    assert resp.json()['items'][99999] == {'id': 99999}
+
+
+def test_big_json_responses_2(example):
+    resp = example.request('GET', '/')
+    assert resp.headers['Content-Type'] == 'application/json'
+    assert resp.json()['items'][99999] == {'id': 99999}
+    assert example.request('GET', '/').content == resp.content
+
+
+def test_big_json_responses_3(example):
+    resp = example.request('GET', '/')
+    assert resp.headers['Content-Type'] == 'application/json'
+    assert resp.json()['items'][99999] == {'id': 99999}
+
+
 @pytest.mark.skipif(not os.path.exists('/etc/services'),
                     reason='requires a specific file')
 def test_body_from_file_1(example):
@@ -353,6 +487,26 @@ def test_body_from_file_1(example):
     assert '80/tcp' in resp.text
 
 
+def test_large_responses_2(example):
+    resp1 = example.request('GET', '/')
+    resp2 = example.request('GET', '/')
+    assert resp1.headers['Content-Type'] == 'application/octet-stream'
+    assert resp1.headers['Content-Length'] == str(10 * 1024**2)
+    assert len(resp1.content) == 10 * 1024**2
+    assert resp1.content == resp2.content
+    resp = example.request('HEAD', '/')
+    assert resp.headers['Content-Length'] == str(10 * 1024**2)
+
+
+def test_large_responses_3(example):
+    resp = example.request('GET', '/text')
+    assert resp.headers['Content-Type'] == 'text/plain; charset=utf-8'
+    assert len(resp.content) == 1024**2
+    assert resp.text.split()[0].istitle()
+    resp = example.request('GET', '/')
+    assert resp.content == (b'0123456789' * 1024**2)[:1024**2]
+
+
 def test_custom_methods_1_allowed(example):
     resp = example.request('FROBNICATE', '/some/resource')
     assert resp.status_code == 200
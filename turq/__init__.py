@@ -1 +1,2 @@
 from turq.__metadata__ import version as __version__
+from turq.mock import serve
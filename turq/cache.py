@@ -0,0 +1,306 @@
+# An HTTP cache for responses that `forward()` gets from upstream,
+# so that a mock in front of a slow service can answer repeated reads
+# by itself. It works like a shared cache as per RFC 7234, but simplified:
+# only GET and HEAD, only responses with explicit freshness or validators
+# (no heuristics), and no partial content.
+
+import collections
+import logging
+import threading
+import time
+
+from turq.util.http import parse_cache_control, parse_date
+
+
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+
+# Rough per-entry cost of everything but the headers and the body.
+ENTRY_OVERHEAD = 512
+
+CACHEABLE_METHODS = ['GET', 'HEAD']
+CACHEABLE_STATUSES = [200, 203, 204, 300, 301, 308, 404, 405, 410, 414, 501]
+# Headers from a 304 that must not replace those of the stored response.
+KEEP_ON_REFRESH = ['content-length', 'content-encoding', 'transfer-encoding',
+                   'content-type']
+
+# How each request was handled, for `ForwardCache.stats`.
+OUTCOMES = ['hit', 'stale', 'revalidated', 'miss', 'bypass']
+
+logger = logging.getLogger('turq.cache')
+
+
+class ForwardCache:
+
+    # `fetch` takes a function that actually forwards the request,
+    # given the headers to send, and returns a `turq.rules.Response`.
+    # All cached responses are kept in one LRU list, bounded
+    # by their (approximate) total size in bytes.
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._entries = collections.OrderedDict()   # key -> [variants]
+        self._bytes = 0
+        self._counts = collections.Counter()
+        self._lock = threading.Lock()
+
+    def fetch(self, key, request, forward):
+        # `key` identifies the upstream resource (everything but headers).
+        # Returns the response and how it was obtained (see `OUTCOMES`).
+        (response, outcome) = self._fetch(key, request, forward)
+        with self._lock:
+            self._counts[outcome] += 1
+        return (response, outcome)
+
+    def _fetch(self, key, request, forward):
+        request_cc = parse_cache_control(_values(request.raw_headers,
+                                                 'Cache-Control'))
+        if request.method not in CACHEABLE_METHODS:
+            # Unsafe methods invalidate what we have for the same target.
+            self._invalidate(key)
+            return (forward(request.raw_headers), 'bypass')
+        if 'no-store' in request_cc:
+            return (forward(request.raw_headers), 'bypass')
+
+        # Conditionals from the client are not forwarded: we need
+        # a full response to store. The client gets a full response, too.
+        headers = [(name, value) for (name, value) in request.raw_headers
+                   if name.lower() not in ['if-none-match',
+                                           'if-modified-since']]
+        stored = self._lookup(key, request.raw_headers)
+        now = time.monotonic()
+        force_revalidate = ('no-cache' in request_cc or
+                            request_cc.get('max-age') == '0')
+        if stored is not None and not force_revalidate:
+            if stored.is_fresh(now):
+                return (stored.to_response(now), 'hit')
+            if stored.may_serve_stale(now):
+                self._revalidate_in_background(key, request, stored,
+                                               headers, forward)
+                return (stored.to_response(now), 'stale')
+        return self._revalidate(key, request, stored, headers, forward)
+
+    def _revalidate(self, key, request, stored, headers, forward):
+        if stored is not None and stored.has_validators:
+            response = forward(headers + stored.conditional_headers())
+            if response.status_code == 304:
+                refreshed = stored.refreshed(response, request.raw_headers)
+                self._store(key, refreshed)
+                return (refreshed.to_response(time.monotonic()),
+                        'revalidated')
+        else:
+            response = forward(headers)
+        if _is_storable(request, response):
+            self._store(key, _Stored(response, request.raw_headers))
+        return (response, 'miss')
+
+    def _revalidate_in_background(self, key, request, stored, headers,
+                                  forward):
+        with self._lock:
+            if stored.revalidating:
+                return
+            stored.revalidating = True
+
+        def revalidate():
+            try:
+                self._revalidate(key, request, stored, headers, forward)
+            except Exception as exc:    # pylint: disable=broad-except
+                logger.error('cannot revalidate cached response: %s', exc)
+            finally:
+                stored.revalidating = False
+
+        threading.Thread(target=revalidate, daemon=True).start()
+
+    def _lookup(self, key, request_headers):
+        with self._lock:
+            for stored in self._entries.get(key, []):
+                if stored.matches(request_headers):
+                    self._entries.move_to_end(key)
+                    return stored
+        return None
+
+    def _store(self, key, stored):
+        if stored.size > self.max_bytes:
+            return
+        with self._lock:
+            variants = []
+            for other in self._entries.pop(key, []):
+                if other.vary == stored.vary:
+                    self._bytes -= other.size       # replaced
+                else:
+                    variants.append(other)
+            self._entries[key] = variants + [stored]
+            self._bytes += stored.size
+            while self._bytes > self.max_bytes:
+                (_, evicted) = self._entries.popitem(last=False)
+                self._bytes -= sum(other.size for other in evicted)
+
+    def _invalidate(self, key):
+        (host, port, tls, _, target) = key
+        with self._lock:
+            for method in CACHEABLE_METHODS:
+                evicted = self._entries.pop((host, port, tls, method, target),
+                                            [])
+                self._bytes -= sum(other.size for other in evicted)
+
+    def stats(self):
+        with self._lock:
+            counts = dict(self._counts)
+            entries = sum(len(variants) for variants in self._entries.values())
+            size = self._bytes
+        total = sum(counts.values())
+        served_locally = sum(counts.get(outcome, 0)
+                             for outcome in ['hit', 'stale', 'revalidated'])
+        return dict(
+            {outcome: counts.get(outcome, 0) for outcome in OUTCOMES},
+            entries=entries, bytes=size,
+            hit_ratio=(served_locally / total if total else None))
+
+
+class _Stored:
+
+    # One stored response (a variant, in terms of ``Vary``).
+
+    def __init__(self, response, request_headers):
+        self.http_version = response.http_version
+        self.status_code = response.status_code
+        self.reason = response.reason
+        self.headers = list(response.raw_headers)
+        self.body = response.body
+        self.stored_at = time.monotonic()
+        self.revalidating = False
+
+        self.vary = {name: _values(request_headers, name)
+                     for name in _vary_names(self.headers)}
+        cache_control = parse_cache_control(_values(self.headers,
+                                                    'Cache-Control'))
+        date = _first_date(self.headers, 'Date') or time.time()
+        age = _int(_first(self.headers, 'Age')) or 0
+        self.initial_age = max(age, time.time() - date)
+        self.lifetime = _lifetime(cache_control, self.headers, date)
+        self.no_cache = 'no-cache' in cache_control
+        self.stale_while_revalidate = (
+            0 if 'must-revalidate' in cache_control or
+            'proxy-revalidate' in cache_control
+            else _int(cache_control.get('stale-while-revalidate')) or 0)
+        self.etag = _first(self.headers, 'ETag')
+        self.last_modified = _first(self.headers, 'Last-Modified')
+        self.size = (ENTRY_OVERHEAD + len(self.body) +
+                     sum(len(name) + len(value)
+                         for (name, value) in self.headers))
+
+    @property
+    def has_validators(self):
+        return bool(self.etag or self.last_modified)
+
+    def conditional_headers(self):
+        headers = []
+        if self.etag:
+            headers.append(('If-None-Match', self.etag))
+        if self.last_modified:
+            headers.append(('If-Modified-Since', self.last_modified))
+        return headers
+
+    def age(self, now):
+        return self.initial_age + (now - self.stored_at)
+
+    def is_fresh(self, now):
+        return not self.no_cache and self.age(now) < self.lifetime
+
+    def may_serve_stale(self, now):
+        return (not self.no_cache and self.has_validators and
+                self.age(now) < self.lifetime + self.stale_while_revalidate)
+
+    def matches(self, request_headers):
+        return all(_values(request_headers, name) == values
+                   for (name, values) in self.vary.items())
+
+    def refreshed(self, not_modified, request_headers):
+        # RFC 7234 Section 4.3.4: update the stored headers from a 304.
+        new_names = {name.lower() for (name, _) in not_modified.raw_headers
+                     if name.lower() not in KEEP_ON_REFRESH}
+        response = _ResponseData(
+            self.http_version, self.status_code, self.reason,
+            [(name, value) for (name, value) in self.headers
+             if name.lower() not in new_names] +
+            [(name, value) for (name, value) in not_modified.raw_headers
+             if name.lower() in new_names],
+            self.body)
+        return _Stored(response, request_headers)
+
+    def to_response(self, now):
+        from turq.rules import Response
+        response = Response()
+        response.http_version = self.http_version
+        response.status_code = self.status_code
+        response.reason = self.reason
+        response.raw_headers[:] = [(name, value)
+                                   for (name, value) in self.headers
+                                   if name.lower() != 'age']
+        response.raw_headers.append(('Age', str(int(self.age(now)))))
+        response.body = self.body
+        return response
+
+
+_ResponseData = collections.namedtuple('_ResponseData', [
+    'http_version', 'status_code', 'reason', 'raw_headers', 'body',
+])
+
+
+def _is_storable(request, response):
+    if response.status_code not in CACHEABLE_STATUSES:
+        return False
+    request_cc = parse_cache_control(_values(request.raw_headers,
+                                             'Cache-Control'))
+    cache_control = parse_cache_control(_values(response.raw_headers,
+                                                'Cache-Control'))
+    if 'no-store' in request_cc or 'no-store' in cache_control or \
+            'private' in cache_control:
+        return False
+    if '*' in _vary_names(response.raw_headers):
+        return False
+    if _first(request.raw_headers, 'Authorization') is not None and not (
+            {'public', 's-maxage', 'must-revalidate'} & set(cache_control)):
+        return False
+    return bool({'max-age', 's-maxage', 'no-cache'} & set(cache_control) or
+                _first(response.raw_headers, 'Expires') is not None or
+                _first(response.raw_headers, 'ETag') is not None or
+                _first(response.raw_headers, 'Last-Modified') is not None)
+
+
+def _lifetime(cache_control, headers, date):
+    for directive in ['s-maxage', 'max-age']:
+        if directive in cache_control:
+            return _int(cache_control[directive]) or 0
+    expires = _first(headers, 'Expires')
+    if expires is not None:
+        # An invalid date (such as "0") means "already expired".
+        return max(0, (parse_date(expires) or 0) - date)
+    return 0
+
+
+def _values(headers, name):
+    name = name.lower()
+    return [value for (other, value) in headers if other.lower() == name]
+
+
+def _first(headers, name):
+    values = _values(headers, name)
+    return values[0] if values else None
+
+
+def _first_date(headers, name):
+    value = _first(headers, name)
+    return None if value is None else parse_date(value)
+
+
+def _vary_names(headers):
+    return sorted({name.strip().lower()
+                   for value in _values(headers, 'Vary')
+                   for name in value.split(',') if name.strip()})
+
+
+def _int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
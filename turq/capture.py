@@ -0,0 +1,117 @@
+# Keeps the most recent exchanges (request + response) in memory,
+# so that they can be looked at through the editor without `--verbose`.
+# Entries are stored as they come, in compact form; all formatting
+# is done when somebody actually queries them.
+
+import collections
+import fnmatch
+import itertools
+import threading
+
+
+DEFAULT_MAX_ENTRIES = 1000
+DEFAULT_MAX_BYTES = 16 * 1024 * 1024
+
+# Only this much of each request and response body is kept.
+BODY_PREFIX_SIZE = 1024
+
+# Rough per-entry cost of the objects themselves (tuple, ints, etc.),
+# on top of the strings and bytes they contain.
+ENTRY_OVERHEAD = 512
+
+Exchange = collections.namedtuple('Exchange', [
+    'id', 'time', 'client', 'method', 'target', 'request_headers',
+    'request_body', 'request_body_size', 'status', 'reason',
+    'response_headers', 'response_body', 'response_body_size',
+])
+
+
+class Capture:
+
+    # A ring buffer bounded both by number of entries and by (approximate)
+    # memory used. Writers only hold the lock to append and evict.
+
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES,
+                 max_bytes=DEFAULT_MAX_BYTES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = collections.deque()
+        self._bytes = 0
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def add(self, *fields):
+        # `fields` are all those of `Exchange` except `id`.
+        size = ENTRY_OVERHEAD + _size(fields)
+        with self._lock:
+            self._entries.append((Exchange(next(self._ids), *fields), size))
+            self._bytes += size
+            while len(self._entries) > self.max_entries or \
+                    (self._bytes > self.max_bytes and len(self._entries) > 1):
+                (_, evicted_size) = self._entries.popleft()
+                self._bytes -= evicted_size
+
+    def query(self, path=None, status=None, since=None):
+        # `path` is a glob pattern, such as ``/api/*``. `status` is a code
+        # (``404``) or a class (``4xx``). `since` is the ID of the last
+        # exchange already seen: only newer ones are returned.
+        with self._lock:
+            entries = [entry for (entry, _) in self._entries]
+        if since is not None:
+            entries = [entry for entry in entries if entry.id > since]
+        if path is not None:
+            entries = [entry for entry in entries
+                       if fnmatch.fnmatchcase(entry.target.split('?')[0],
+                                              path)]
+        if status is not None:
+            entries = [entry for entry in entries
+                       if _status_matches(entry.status, status)]
+        return entries
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+
+def _size(fields):
+    total = 0
+    for field in fields:
+        if isinstance(field, (str, bytes)):
+            total += len(field)
+        elif isinstance(field, list):
+            total += sum(len(name) + len(value) for (name, value) in field)
+    return total
+
+
+def _status_matches(code, pattern):
+    pattern = str(pattern).lower()
+    if pattern.endswith('xx'):
+        return str(code).startswith(pattern[:-2])
+    return str(code) == pattern
+
+
+def to_json(entry):
+    return {
+        'id': entry.id,
+        'time': entry.time,
+        'client': entry.client,
+        'request': {
+            'method': entry.method,
+            'target': entry.target,
+            'headers': entry.request_headers,
+            'body': _decode_body(entry.request_body),
+            'body_size': entry.request_body_size,
+        },
+        'response': {
+            'status': entry.status,
+            'reason': entry.reason,
+            'headers': entry.response_headers,
+            'body': _decode_body(entry.response_body),
+            'body_size': entry.response_body_size,
+        },
+    }
+
+
+def _decode_body(data):
+    return None if data is None else data.decode('utf-8', 'replace')
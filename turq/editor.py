@@ -3,6 +3,7 @@
 import base64
 import hashlib
 import html
+import json
 import mimetypes
 import os
 import pkgutil
@@ -16,19 +17,33 @@ import wsgiref.simple_server
 import falcon
 import werkzeug.formparser
 
+import turq.capture
 import turq.examples
+import turq.live
+import turq.rules
 from turq.util.http import guess_external_url
+import turq.util.memory
 
 
 STATIC_PREFIX = '/static/'
 
+# How often to send something on an idle live stream, so that we notice
+# when the client goes away.
+LIVE_KEEPALIVE = 15     # seconds
 
-def make_server(host, port, ipv6, password, mock_server):
+
+def make_server(host, port, ipv6, password, mock_servers):
     editor = falcon.API(media_type='text/plain; charset=utf-8',
                         middleware=[CommonHeaders()])
     # Microsoft Edge doesn't send ``Authorization: Digest`` to ``/``.
     # Can be circumvented with ``/?``, but I think ``/editor`` is better.
-    editor.add_route('/editor', EditorResource(mock_server, password))
+    editor_resource = EditorResource(mock_servers, password)
+    editor.add_route('/editor', editor_resource)
+    editor.add_route('/editor/state', editor_resource, suffix='state')
+    editor.add_route('/editor/cache', editor_resource, suffix='cache')
+    editor.add_route('/editor/live', editor_resource, suffix='live')
+    editor.add_route('/editor/memory', editor_resource, suffix='memory')
+    editor.add_route('/requests', editor_resource, suffix='requests')
     editor.add_route('/', RedirectResource())
     editor.add_sink(static_file, STATIC_PREFIX)
     editor.set_error_serializer(text_error_serializer)
@@ -71,20 +86,28 @@ class EditorResource:
     template = string.Template(
         pkgutil.get_data('turq', 'editor/editor.html.tpl').decode('utf-8'))
 
-    def __init__(self, mock_server, password):
-        self.mock_server = mock_server
+    def __init__(self, mock_servers, password):
+        # The first mock is the default one; others are selected by port.
+        self.mock_servers = {server.server_address[1]: server
+                             for server in mock_servers}
+        self.default_port = mock_servers[0].server_address[1]
         self.password = password
         self.nonce = self.new_nonce()
         self._lock = threading.Lock()
 
     def on_get(self, req, resp):
         self.check_auth(req)
+        mock_server = self.select_mock(req.get_param('port'))
         resp.content_type = 'text/html; charset=utf-8'
-        (mock_host, mock_port, *_) = self.mock_server.server_address
+        (mock_host, mock_port, *_) = mock_server.server_address
         resp.body = self.template.substitute(
             mock_host=html.escape(mock_host), mock_port=mock_port,
-            mock_url=html.escape(guess_external_url(mock_host, mock_port)),
-            rules=html.escape(self.mock_server.rules),
+            mock_url=html.escape(guess_external_url(
+                mock_host, mock_port, mock_server.scheme)),
+            mock_nav=self.render_nav(mock_port),
+            state_path=html.escape(self.editor_path(mock_port, 'state')),
+            live_path=html.escape(self.editor_path(mock_port, 'live')),
+            rules=html.escape(mock_server.rules),
             examples=turq.examples.load_html(initial_header_level=3))
 
     def on_post(self, req, resp):
@@ -94,16 +117,131 @@ class EditorResource:
         (_, form, _) = werkzeug.formparser.parse_form_data(req.env)
         if 'rules' not in form:
             raise falcon.HTTPBadRequest('Bad form')
+        mock_server = self.select_mock(form.get('port'))
         try:
-            self.mock_server.install_rules(form['rules'])
-        except SyntaxError as exc:
+            mock_server.install_rules(form['rules'])
+        except (SyntaxError, turq.rules.RulesSetupError) as exc:
             resp.status = falcon.HTTP_422   # Unprocessable Entity
             resp.body = str(exc)
         else:
             resp.status = falcon.HTTP_303   # See Other
-            resp.location = '/editor'
+            resp.location = self.editor_path(mock_server.server_address[1])
             resp.body = 'Rules installed successfully.'
 
+    def on_get_state(self, req, resp):
+        self.check_auth(req)
+        mock_server = self.select_mock(req.get_param('port'))
+        lines = []
+        for (key, value, ttl) in sorted(mock_server.state.items(),
+                                        key=lambda item: repr(item[0])):
+            line = '%r = %r' % (key, value)
+            if ttl is not None:
+                line += '  (expires in %.1f s)' % ttl
+            lines.append(line + '\n')
+        resp.body = ''.join(lines) or 'No state.\n'
+
+    def on_get_cache(self, req, resp):
+        self.check_auth(req)
+        mock_server = self.select_mock(req.get_param('port'))
+        stats = mock_server.forward_cache.stats()
+        hit_ratio = stats.pop('hit_ratio')
+        lines = ['%s: %d\n' % (name.replace('_', ' '), value)
+                 for (name, value) in stats.items()]
+        lines.append('hit ratio: %s\n' % ('n/a' if hit_ratio is None
+                                           else '%.1f%%' % (hit_ratio * 100)))
+        resp.body = ''.join(lines)
+
+    def on_get_live(self, req, resp):
+        # Server-Sent Events, one per exchange on the mock. The request
+        # threads only queue raw summaries; they are formatted here,
+        # in the editor thread that serves this stream.
+        self.check_auth(req)
+        feed = self.select_mock(req.get_param('port')).live
+
+        def stream():
+            # Subscribe only once the response actually starts,
+            # so that `finally` is sure to run.
+            subscriber = feed.subscribe()
+            try:
+                yield b'retry: 1000\n\n'
+                while True:
+                    (summaries, dropped) = subscriber.get(LIVE_KEEPALIVE)
+                    if not summaries:
+                        yield b': keep-alive\n\n'
+                    for summary in summaries:
+                        yield ('event: exchange\ndata: %s\n\n' % json.dumps(
+                            turq.live.to_json(summary, dropped))).encode()
+            finally:
+                feed.unsubscribe(subscriber)
+
+        resp.content_type = 'text/event-stream'
+        resp.cache_control = ['no-cache']
+        resp.stream = stream()
+
+    def on_get_memory(self, req, resp):
+        self.check_auth(req)
+        resp.body = turq.util.memory.report(req.get_param_as_int(
+            'limit', min_value=1, default=turq.util.memory.DEFAULT_LIMIT))
+
+    def on_post_memory(self, req, resp):
+        # ``action`` is ``start``, ``snapshot`` (take a baseline for later
+        # reports to compare to), or ``stop``.
+        self.check_auth(req)
+        (_, form, _) = werkzeug.formparser.parse_form_data(req.env)
+        action = form.get('action')
+        try:
+            if action == 'start':
+                turq.util.memory.start_tracing()
+            elif action == 'snapshot':
+                turq.util.memory.take_baseline()
+            elif action == 'stop':
+                turq.util.memory.stop_tracing()
+            else:
+                raise falcon.HTTPBadRequest('Bad action')
+        except ValueError as exc:
+            raise falcon.HTTPBadRequest(str(exc))
+        resp.status = falcon.HTTP_303   # See Other
+        resp.location = '/editor/memory'
+        resp.body = 'Done.'
+
+    def on_get_requests(self, req, resp):
+        self.check_auth(req)
+        mock_server = self.select_mock(req.get_param('port'))
+        if mock_server.capture is None:
+            raise falcon.HTTPNotFound(title='Capture is disabled')
+        exchanges = mock_server.capture.query(
+            path=req.get_param('path'), status=req.get_param('status'),
+            since=req.get_param_as_int('since'))
+        resp.content_type = 'application/json'
+        resp.body = json.dumps([turq.capture.to_json(exchange)
+                                for exchange in exchanges], indent=2)
+
+    def select_mock(self, port):
+        if not port:
+            return self.mock_servers[self.default_port]
+        try:
+            return self.mock_servers[int(port)]
+        except (ValueError, KeyError):
+            raise falcon.HTTPNotFound(title='No mock on port %s' % port)
+
+    def editor_path(self, port, suffix=None):
+        path = '/editor/%s' % suffix if suffix else '/editor'
+        if port == self.default_port:
+            return path
+        return '%s?port=%d' % (path, port)
+
+    def render_nav(self, current_port):
+        if len(self.mock_servers) < 2:
+            return ''
+        items = []
+        for port in sorted(self.mock_servers):
+            if port == current_port:
+                items.append('<strong>%d</strong>' % port)
+            else:
+                items.append('<a href="%s" target=_self>%d</a>' %
+                             (self.editor_path(port), port))
+        return '<nav>Mocks: %s</nav>' % ' '.join(items)
+
     # We use HTTP digest authentication here, which provides a fairly high
     # level of protection. We use only one-time nonces, so replay attacks
     # should not be possible. An active man-in-the-middle could still intercept
@@ -115,18 +253,19 @@ class EditorResource:
         if not self.password:
             return
         auth = werkzeug.http.parse_authorization_header(req.auth)
-        password_ok = False
-        if self.check_password(req, auth):
-            password_ok = True
-            with self._lock:
-                if auth.nonce == self.nonce:
-                    self.nonce = self.new_nonce()
-                    return
+        password_ok = self.check_password(req, auth)
+        with self._lock:
+            if password_ok and auth.nonce == self.nonce:
+                self.nonce = self.new_nonce()
+                return
+            # Read under the lock, so that we never send a nonce
+            # that another thread is just now replacing.
+            nonce = self.nonce
         raise falcon.HTTPUnauthorized(headers={
             'WWW-Authenticate':
                 'Digest realm="%s", qop="auth", charset=UTF-8, '
                 'nonce="%s", stale=%s' %
-                (self.realm, self.nonce, 'true' if password_ok else 'false')})
+                (self.realm, nonce, 'true' if password_ok else 'false')})
 
     def check_password(self, req, auth):
         if not auth:
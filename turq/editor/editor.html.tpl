@@ -20,18 +20,25 @@
     <body>
         <main>
             <h1>Turq editor</h1>
+            $mock_nav
             <p>
                 Mock server is listening on $mock_host port $mock_port —
                 <span class=try>try <a href="$mock_url">$mock_url</a></span>
+                (<a href="$state_path">state</a>)
             </p>
             <!-- `target` necessary here to override the `base` -->
             <form method=POST action=/editor target=_self>
+                <input type=hidden name=port value=$mock_port>
                 <textarea name=rules cols=79 rows=15>$rules</textarea>
                 <p class=submit>
                     <input type=submit name=do value=Install accesskey=i>
                     <span class=status></span>
                 </p>
             </form>
+            <details class=live data-src="$live_path">
+                <summary>Live requests <span class=dropped></span></summary>
+                <ol></ol>
+            </details>
         </main>
         <aside>
             <h2>Examples</h2>
@@ -80,8 +80,51 @@ function hideStatus() {
 }
 
 
+var MAX_LIVE_ITEMS = 100;
+var liveSource = null;
+
+
+function setUpLivePanel() {
+    // Only stream requests from the server while the panel is open.
+    var panel = document.querySelector('details.live');
+    panel.addEventListener('toggle', function () {
+        if (panel.open) {
+            liveSource = new EventSource(panel.getAttribute('data-src'));
+            liveSource.addEventListener('exchange', onExchange);
+        } else if (liveSource !== null) {
+            liveSource.close();
+            liveSource = null;
+        }
+    });
+}
+
+
+function onExchange(e) {
+    var exchange = JSON.parse(e.data);
+    var list = document.querySelector('.live ol');
+    var item = document.createElement('li');
+    item.textContent =
+        new Date(exchange.time * 1000).toLocaleTimeString() + '  ' +
+        exchange.method + ' ' + exchange.target + ' \u2192 ' +
+        exchange.status + ' ' + exchange.reason + ' (' +
+        exchange.response_body_size + ' bytes, ' +
+        Math.round(exchange.duration * 1000) + ' ms)';
+    if (exchange.status >= 400) {
+        item.classList.add('error');
+    }
+    list.insertBefore(item, list.firstChild);
+    while (list.children.length > MAX_LIVE_ITEMS) {
+        list.removeChild(list.lastChild);
+    }
+    // The server drops events if we can't keep up.
+    document.querySelector('.live .dropped').textContent =
+        exchange.dropped ? '(' + exchange.dropped + ' dropped)' : '';
+}
+
+
 document.addEventListener('DOMContentLoaded', function() {
     document.querySelector('textarea').focus();
     installCodeMirror();
     interceptForm();
+    setUpLivePanel();
 });
@@ -1,11 +1,10 @@
 import pkgutil
 import xml.etree.ElementTree
 
-import docutils.core
-
 
 def load_pairs():
     # Load pairs of "example ID, rules code" for the test suite.
+    import docutils.core
     rst_code = _load_rst()
     xml_code = docutils.core.publish_string(rst_code, writer_name='xml')
     tree = xml.etree.ElementTree.fromstring(xml_code)
@@ -19,6 +18,7 @@ def load_pairs():
 
 def load_html(initial_header_level):
     # Render an HTML fragment ready for inclusion into a page.
+    import docutils.core
     rst_code = _load_rst()
     parts = docutils.core.publish_parts(
         rst_code, writer_name='html',
@@ -0,0 +1,72 @@
+# Streams summaries of requests and responses, as they happen, to whoever
+# is watching (the editor's live panel). Publishing must never slow down
+# the mock server: it only appends a tuple to each subscriber's queue,
+# which is bounded and drops the oldest events when a subscriber falls
+# behind. All formatting is done by the subscriber.
+
+import collections
+import threading
+
+
+DEFAULT_QUEUE_SIZE = 1000
+
+Summary = collections.namedtuple('Summary', [
+    'time', 'client', 'method', 'target', 'status', 'reason',
+    'response_body_size', 'duration',
+])
+
+
+class LiveFeed:
+
+    def __init__(self):
+        # Replaced, never changed in place, so `publish` needs no lock.
+        self._subscribers = ()
+        self._lock = threading.Lock()
+
+    def publish(self, *fields):
+        # `fields` are those of `Summary`.
+        if self._subscribers:
+            summary = Summary(*fields)
+            for subscriber in self._subscribers:
+                subscriber.put(summary)
+
+    def subscribe(self, queue_size=DEFAULT_QUEUE_SIZE):
+        subscriber = Subscriber(queue_size)
+        with self._lock:
+            self._subscribers += (subscriber,)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            self._subscribers = tuple(other for other in self._subscribers
+                                      if other is not subscriber)
+
+
+class Subscriber:
+
+    def __init__(self, queue_size):
+        self._events = collections.deque(maxlen=queue_size)
+        self._ready = threading.Condition(threading.Lock())
+        self.dropped = 0
+
+    def put(self, summary):
+        with self._ready:
+            if len(self._events) == self._events.maxlen:
+                self.dropped += 1       # The deque drops the oldest
+            self._events.append(summary)
+            self._ready.notify()
+
+    def get(self, timeout=None):
+        # All events queued so far, waiting up to `timeout` seconds
+        # for at least one. Returns ``(events, dropped)``.
+        with self._ready:
+            self._ready.wait_for(lambda: self._events, timeout)
+            events = list(self._events)
+            self._events.clear()
+            return (events, self.dropped)
+
+
+def to_json(summary, dropped=0):
+    # `dropped` is how many events the subscriber has missed so far.
+    return dict(summary._asdict(), duration=round(summary.duration, 6),
+                dropped=dropped)
@@ -1,21 +1,33 @@
 import argparse
 import base64
+import functools
+import json
 import logging
 import os
 import sys
+import sysconfig
+import tempfile
 import threading
-
-import colorlog
+import time
 
 import turq
-import turq.editor
 import turq.mock
+import turq.rules
+import turq.cache
+from turq.capture import (DEFAULT_MAX_BYTES, DEFAULT_MAX_ENTRIES,
+                          Capture)
+from turq.recording import Recorder
 from turq.util.http import guess_external_url
+from turq.util.singleflight import SingleFlight
+from turq.util.watch import watch_file
+from turq.util.watchdog import Watchdog
 
 DEFAULT_ADDRESS = ''       # All interfaces
 DEFAULT_MOCK_PORT = 13085
 DEFAULT_EDITOR_PORT = 13086
 DEFAULT_RULES = 'error(404)\n'
+DEFAULT_RULES_CPU_LIMIT = 10     # seconds
+SHUTDOWN_WAIT = 5                # seconds
 
 logger = logging.getLogger('turq')
 
@@ -43,10 +55,19 @@ def parse_args(argv):
                         help='IP address or hostname to listen on')
     parser.add_argument('-p', '--mock-port', metavar='PORT', type=int,
                         default=DEFAULT_MOCK_PORT,
-                        help='port for the mock server to listen on')
+                        help='port for the mock server to listen on '
+                             '(0 for any free port)')
     parser.add_argument('--editor-port', metavar='PORT', type=int,
                         default=DEFAULT_EDITOR_PORT,
-                        help='port for the rules editor to listen on')
+                        help='port for the rules editor to listen on '
+                             '(0 for any free port)')
+    parser.add_argument('--port-file', metavar='PATH',
+                        help='once ready to accept connections, write '
+                             'the actual ports to PATH (as JSON)')
+    parser.add_argument('--ready-fd', metavar='FD', type=int,
+                        help='once ready to accept connections, write '
+                             'the actual ports (as JSON) to file '
+                             'descriptor FD and close it')
     parser.add_argument('-6', '--ipv6', action='store_true',
                         default=False,
                         help=('listen on IPv6 instead of IPv4 '
@@ -54,6 +75,63 @@ def parse_args(argv):
     parser.add_argument('-r', '--rules', metavar='PATH',
                         type=argparse.FileType('r'),
                         help='file with initial rules code')
+    parser.add_argument('-l', '--listen', metavar='PORT=PATH',
+                        type=listen_spec, action='append', default=[],
+                        help='also run a mock on PORT with rules from PATH '
+                             '(may be repeated)')
+    parser.add_argument('-w', '--watch', action='store_true',
+                        help='reinstall rules whenever the --rules '
+                             '(or --listen) file changes')
+    parser.add_argument('--throttle', metavar='BYTES', type=int,
+                        help='limit response bodies to BYTES per second '
+                             'on each connection (rules can override)')
+    parser.add_argument('--record', metavar='PATH',
+                        help='append all requests and responses to PATH, '
+                             'for later use with replay()')
+    parser.add_argument('--rules-cpu-limit', metavar='SECONDS', type=float,
+                        help='abort rules that use more than SECONDS '
+                             'of CPU time on one request (default: %d; '
+                             '0 to disable)' % DEFAULT_RULES_CPU_LIMIT)
+    parser.add_argument('--rules-time-limit', metavar='SECONDS', type=float,
+                        help='abort rules that take longer than SECONDS '
+                             'on one request (default: no limit)')
+    parser.add_argument('--backlog', metavar='N', type=int,
+                        default=turq.mock.DEFAULT_SOCKET_OPTIONS.backlog,
+                        help='queue up to N connections waiting to be '
+                             'accepted by the mock (default: %(default)s)')
+    parser.add_argument('--no-nodelay', action='store_true',
+                        help='do not set TCP_NODELAY on mock connections')
+    parser.add_argument('--defer-accept', metavar='SECONDS', type=int,
+                        help='set TCP_DEFER_ACCEPT on the mock (Linux)')
+    parser.add_argument('--fastopen', metavar='QUEUE', type=int,
+                        help='enable TCP Fast Open on the mock '
+                             'with the given queue length')
+    parser.add_argument('--sndbuf', metavar='BYTES', type=int,
+                        help='set SO_SNDBUF on mock connections')
+    parser.add_argument('--rcvbuf', metavar='BYTES', type=int,
+                        help='set SO_RCVBUF on mock connections')
+    parser.add_argument('--capture', metavar='N', type=int,
+                        default=DEFAULT_MAX_ENTRIES,
+                        help='keep up to N recent requests and responses '
+                             'for /requests on the editor (0 to disable)')
+    parser.add_argument('--capture-memory', metavar='BYTES', type=int,
+                        default=DEFAULT_MAX_BYTES,
+                        help='limit memory used by --capture to '
+                             'about BYTES per mock')
+    parser.add_argument('--forward-cache-size', metavar='BYTES', type=int,
+                        default=turq.cache.DEFAULT_MAX_BYTES,
+                        help='limit memory used to cache upstream responses '
+                             'for forward(..., cache=True) to about BYTES')
+    parser.add_argument('--coalesce-wait', metavar='SECONDS', type=float,
+                        default=turq.mock.DEFAULT_COALESCE_WAIT,
+                        help='with forward(..., coalesce=True), wait at most '
+                             'SECONDS for an identical upstream request')
+    parser.add_argument('--tls-cert', metavar='PATH',
+                        help='serve the mock over TLS (HTTPS) with the '
+                             'certificate (chain) in PATH (PEM format)')
+    parser.add_argument('--tls-key', metavar='PATH',
+                        help='private key for --tls-cert, '
+                             'unless it is in the same file')
     parser.add_argument('-P', '--editor-password', metavar='PASSWORD',
                         default=random_password(),
                         help='explicitly set editor password '
@@ -61,6 +139,13 @@ def parse_args(argv):
     return parser.parse_args(argv[1:])
 
 
+def listen_spec(spec):
+    (port, sep, path) = spec.partition('=')
+    if not (sep and port.isdigit() and path):
+        raise argparse.ArgumentTypeError('expected PORT=PATH, got %r' % spec)
+    return (int(port), path)
+
+
 def excepthook(_type, exc, _traceback):
     sys.stderr.write('turq: error: %s\n' % exc)
 
@@ -71,6 +156,7 @@ def setup_logging(args):
             fmt='%(asctime)s  %(name)s  %(message)s',
             datefmt='%H:%M:%S')
     else:
+        import colorlog
         formatter = colorlog.ColoredFormatter(
             fmt=('%(asctime)s  '
                  '%(name_log_color)s%(name)s%(reset)s  '
@@ -91,41 +177,157 @@ def setup_logging(args):
 
 def run(args):
     rules = args.rules.read() if args.rules else DEFAULT_RULES
-    mock_server = turq.mock.MockServer(args.bind, args.mock_port, args.ipv6,
-                                       rules)
+    tls_context = (turq.mock.make_tls_context(args.tls_cert, args.tls_key)
+                   if args.tls_cert else None)
+    watchdog = make_watchdog(args)
+    socket_options = turq.mock.SocketOptions(
+        backlog=args.backlog, nodelay=not args.no_nodelay,
+        defer_accept=args.defer_accept, fastopen=args.fastopen,
+        sndbuf=args.sndbuf, rcvbuf=args.rcvbuf)
+    # All mocks append to the same recording (`Recorder` is thread-safe).
+    recorder = Recorder(args.record) if args.record else None
+    # Likewise, all mocks share one cache and one set of requests
+    # in flight for `forward`.
+    forward_cache = turq.cache.ForwardCache(args.forward_cache_size)
+    single_flight = SingleFlight(args.coalesce_wait)
+
+    def make_mock_server(port, rules):
+        capture = (Capture(args.capture, args.capture_memory)
+                   if args.capture > 0 else None)
+        return turq.mock.MockServer(args.bind, port, args.ipv6, rules,
+                                    throttle=args.throttle, recorder=recorder,
+                                    tls_context=tls_context, capture=capture,
+                                    watchdog=watchdog,
+                                    socket_options=socket_options,
+                                    forward_cache=forward_cache,
+                                    single_flight=single_flight)
+
+    # Every extra mock is just another listening socket with its own rules
+    # and its own accept thread, so it costs next to nothing compared
+    # to a whole separate Turq process.
+    mock_server = make_mock_server(args.mock_port, rules)
+    rules_paths = [(mock_server, args.rules.name)] if args.rules else []
+    extra_servers = []
+    for (port, path) in args.listen:
+        with open(path) as f:
+            extra_servers.append(make_mock_server(port, f.read()))
+        rules_paths.append((extra_servers[-1], path))
+    mock_servers = [mock_server] + extra_servers
+
+    if args.watch:
+        for (server, path) in rules_paths:
+            watch_file(path, functools.partial(reload_rules, server))
 
     if args.no_editor:
         editor_server = None
     else:
-        editor_server = turq.editor.make_server(
+        # The editor pulls in Falcon and Werkzeug, which take a while
+        # to import, so only do that when the editor is actually needed.
+        from turq.editor import make_server
+        editor_server = make_server(
             args.bind, args.editor_port, args.ipv6,
-            args.editor_password, mock_server)
-        threading.Thread(target=editor_server.serve_forever).start()
+            args.editor_password, mock_servers)
+        # A short poll interval, so that shutting down doesn't wait for it.
+        threading.Thread(target=editor_server.serve_forever,
+                         kwargs={'poll_interval': 0.05}).start()
+
+    for server in extra_servers:
+        threading.Thread(target=server.serve_forever, daemon=True).start()
 
     # Show mock server info just before going into `serve_forever`,
     # to minimize the delay between printing it and actually listening
-    show_server_info('mock', mock_server)
+    for server in mock_servers:
+        show_server_info('mock', server)
     if editor_server is not None:
         show_server_info('editor', editor_server)
         if args.editor_password:
             logger.info('editor password: %s (any username)',
                         args.editor_password)
 
+    if sysconfig.get_config_var('Py_GIL_DISABLED') and \
+            sys._is_gil_enabled():      # pylint: disable=protected-access
+        # Some extension module without free-threading support
+        # (or ``PYTHON_GIL=1``) has turned the GIL back on.
+        logger.warning('the GIL is enabled, so requests will not run '
+                       'in parallel')
+
+    # All sockets are listening by now, so connections will succeed
+    # (they wait in the backlog until `serve_forever` gets to them).
+    ports = {
+        'mock': mock_server.port,
+        'listen': [server.port for server in extra_servers],
+        'editor': (None if editor_server is None
+                   else editor_server.server_address[1]),
+    }
+    if args.port_file:
+        write_port_file(args.port_file, ports)
+    if args.ready_fd is not None:
+        with os.fdopen(args.ready_fd, 'w') as f:
+            f.write(json.dumps(ports) + '\n')
+
     try:
         mock_server.serve_forever()
     except KeyboardInterrupt:
-        mock_server.server_close()
         sys.stderr.write('\n')
 
+    for server in extra_servers:
+        server.shutdown()
+    # Let requests in progress finish (and be recorded, for instance),
+    # but don't hang on a stuck one.
+    deadline = time.monotonic() + SHUTDOWN_WAIT
+    for server in mock_servers:
+        server.wait_for_exchanges(max(deadline - time.monotonic(), 0))
+    for server in mock_servers:
+        server.server_close()
+    if recorder is not None:
+        recorder.close()
+
     if editor_server is not None:
         editor_server.shutdown()
         editor_server.server_close()
 
+    if args.port_file:
+        os.remove(args.port_file)
+
+
+def write_port_file(path, ports):
+    # Write to a temporary file and rename it, so that whoever is waiting
+    # for the file never sees it half-written.
+    (fd, temp_path) = tempfile.mkstemp(
+        dir=os.path.dirname(os.path.abspath(path)), prefix='.turq-ports-')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(ports, f)
+        f.write('\n')
+    os.replace(temp_path, path)
+
+
+def make_watchdog(args):
+    cpu_limit = args.rules_cpu_limit
+    if cpu_limit is None:
+        # Measuring CPU time of a thread is not possible everywhere,
+        # but that shouldn't prevent Turq from starting with defaults.
+        cpu_limit = (DEFAULT_RULES_CPU_LIMIT
+                     if hasattr(time, 'pthread_getcpuclockid') else 0)
+    if not (cpu_limit or args.rules_time_limit):
+        return None
+    return Watchdog(cpu_limit=cpu_limit, time_limit=args.rules_time_limit)
+
+
+def reload_rules(mock_server, path):
+    try:
+        with open(path) as f:
+            mock_server.install_rules(f.read())
+    except (OSError, SyntaxError, ValueError,
+            turq.rules.RulesSetupError) as exc:
+        # Keep serving the old rules until the file is fixed.
+        logger.error('cannot reload rules from %s: %s', path, exc)
+
 
 def show_server_info(label, server):
     (host, port, *_) = server.server_address
+    scheme = getattr(server, 'scheme', 'http')
     logger.info('%s on port %d - try %s',
-                label, port, guess_external_url(host, port))
+                label, port, guess_external_url(host, port, scheme))
 
 
 def random_password():
@@ -2,15 +2,56 @@
 # It tries to be mostly HTTP-compliant by default, but it doesn't care at all
 # about performance. In particular, there are no explicit timeouts.
 
+import collections
+import contextlib
 import logging
 import socket
 import socketserver
+import struct
+import threading
 
 import h11
 
-from turq.rules import RULES_FILENAME, RulesContext
+from turq.cache import ForwardCache
+from turq.live import LiveFeed
+from turq.rules import Rules, RulesContext, RulesSetupError
+from turq.state import State
 import turq.util.http
 from turq.util.logging import getNextLogger
+from turq.util.singleflight import SingleFlight
+from turq.util.throttle import TokenBucket
+
+
+# Data at least this big is sent to the socket directly, rather than
+# copied into one buffer with the framing around it.
+PASSTHROUGH_SIZE = 64 * 1024
+
+# Accept at most this many pending connections per wakeup of the accept
+# loop, so that it still gets around to checking for `shutdown`.
+ACCEPT_BATCH = 64
+
+# How long ``forward(..., coalesce=True)`` waits for an identical
+# upstream request before giving up.
+DEFAULT_COALESCE_WAIT = 30      # seconds
+
+
+# Options for the listening socket and accepted connections.
+# `None` leaves the system default alone.
+SocketOptions = collections.namedtuple('SocketOptions', [
+    'backlog',          # Length of the queue of not yet accepted connections
+    'nodelay',          # Disable Nagle's algorithm (``TCP_NODELAY``)
+    'defer_accept',     # Seconds to wait for data before accepting (Linux)
+    'fastopen',         # Length of the TCP Fast Open queue (Linux, macOS)
+    'sndbuf',           # Socket buffer sizes in bytes
+    'rcvbuf',
+])
+
+# The default backlog of 5 (from `socketserver`) drops connections
+# in even a modest burst, and clients then retry only after 1-3 seconds.
+# The system further limits it to ``net.core.somaxconn``.
+DEFAULT_SOCKET_OPTIONS = SocketOptions(backlog=1024, nodelay=True,
+                                       defer_accept=None, fastopen=None,
+                                       sndbuf=None, rcvbuf=None)
 
 
 class MockServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
@@ -18,17 +59,189 @@ class MockServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
     allow_reuse_address = True    # Prevent "Address already in use" on restart
     daemon_threads = True
 
-    def __init__(self, host, port, ipv6, initial_rules,
+    def __init__(self, host, port, ipv6, initial_rules, throttle=None,
+                 recorder=None, tls_context=None, capture=None,
+                 watchdog=None, socket_options=DEFAULT_SOCKET_OPTIONS,
+                 forward_cache=None, single_flight=None,
                  bind_and_activate=True):
         self.address_family = socket.AF_INET6 if ipv6 else socket.AF_INET
+        self.socket_options = socket_options
+        if socket_options.backlog is not None:
+            self.request_queue_size = socket_options.backlog
+        self.throttle = throttle
+        self.tls_context = tls_context
+        # May be shared by several mock servers in one process.
+        self.recorder = recorder
+        self.state = State()
+        self.capture = capture
+        self.live = LiveFeed()          # For the editor's live panel
+        self.watchdog = watchdog
+        # For ``forward(..., cache=True)`` in the rules.
+        self.forward_cache = forward_cache or ForwardCache()
+        # For ``forward(..., coalesce=True)``.
+        self.single_flight = single_flight or SingleFlight(
+            DEFAULT_COALESCE_WAIT)
+        self._serving_thread = None         # See `serve`
+        self._exchanges = 0                 # See `wait_for_exchanges`
+        self._exchanges_done = threading.Condition()
         super().__init__((host, port), MockHandler, bind_and_activate)
-        self.install_rules(initial_rules)
+        try:
+            self.install_rules(initial_rules)
+        except (SyntaxError, RulesSetupError):
+            self.server_close()
+            raise
+
+    def server_bind(self):
+        # Options set on the listening socket are inherited
+        # by accepted connections.
+        options = self.socket_options
+        for (level, name, value) in [
+                (socket.SOL_SOCKET, 'SO_SNDBUF', options.sndbuf),
+                (socket.SOL_SOCKET, 'SO_RCVBUF', options.rcvbuf),
+                (socket.IPPROTO_TCP, 'TCP_DEFER_ACCEPT', options.defer_accept),
+                (socket.IPPROTO_TCP, 'TCP_FASTOPEN', options.fastopen)]:
+            if value is not None:
+                if not hasattr(socket, name):
+                    raise ValueError('%s is not supported on this platform'
+                                     % name)
+                self.socket.setsockopt(level, getattr(socket, name), value)
+        super().server_bind()
+
+    def server_activate(self):
+        super().server_activate()
+        # See `_handle_request_noblock`.
+        self.socket.setblocking(False)
+
+    def get_request(self):
+        (sock, address) = super().get_request()
+        # `accept` only makes the new socket blocking if the listening
+        # socket has a timeout. Ours is non-blocking instead, and on macOS
+        # and BSD, the new socket inherits ``O_NONBLOCK`` from it.
+        sock.setblocking(True)
+        return (sock, address)
+
+    def set_up_connection(self, sock):
+        if self.socket_options.nodelay:
+            # Responses go out in several writes (head, body, chunks...),
+            # which Nagle's algorithm would hold back.
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def _handle_request_noblock(self):
+        # Unlike `socketserver`, which accepts one connection per wakeup
+        # of `serve_forever`, accept all that are pending (up to a limit).
+        # This is the same as the original otherwise.
+        for _ in range(ACCEPT_BATCH):
+            try:
+                (request, client_address) = self.get_request()
+            except OSError:         # Including `BlockingIOError`: none left
+                return
+            try:
+                self.set_up_connection(request)
+            except OSError:         # E.g. the client has already reset it
+                request.close()
+                continue
+            if self.verify_request(request, client_address):
+                try:
+                    self.process_request(request, client_address)
+                except Exception:           # pylint: disable=broad-except
+                    self.handle_error(request, client_address)
+                    self.shutdown_request(request)
+                except:
+                    self.shutdown_request(request)
+                    raise
+            else:
+                self.shutdown_request(request)
+
+    @contextlib.contextmanager
+    def exchange(self):
+        # Wraps the handling of one request, including what happens
+        # after the response is sent (such as recording it).
+        with self._exchanges_done:
+            self._exchanges += 1
+        try:
+            yield
+        finally:
+            with self._exchanges_done:
+                self._exchanges -= 1
+                self._exchanges_done.notify_all()
+
+    def wait_for_exchanges(self, timeout=None):
+        # Wait until no requests are being handled, but no more than
+        # `timeout` seconds. Idle keep-alive connections don't count.
+        with self._exchanges_done:
+            return self._exchanges_done.wait_for(
+                lambda: self._exchanges == 0, timeout)
 
     def install_rules(self, rules):
-        self.compiled_rules = compile(rules, RULES_FILENAME, 'exec')
-        self.rules = rules
+        # A single assignment, so every request sees either the old rules
+        # or the new ones, even without the GIL. Each request reads
+        # `compiled_rules` just once (see `MockHandler.handle`).
+        self.compiled_rules = Rules(rules)
         logging.getLogger('turq').info('new rules installed')
 
+    @property
+    def rules(self):
+        return self.compiled_rules.source
+
+    @property
+    def scheme(self):
+        return 'https' if self.tls_context else 'http'
+
+    @property
+    def port(self):
+        # The actual port, even if the server was asked for port 0.
+        return self.server_address[1]
+
+    @property
+    def url(self):
+        host = self.server_address[0]
+        if ':' in host:
+            host = '[%s]' % host
+        return '%s://%s:%d' % (self.scheme, host, self.port)
+
+    def close(self):
+        # Stop `serve_forever` (if it's running in another thread)
+        # and release the socket.
+        if self._serving_thread is not None:
+            self.shutdown()
+            self._serving_thread.join()
+            self._serving_thread = None
+        self.server_close()
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def serve(rules, host='localhost', port=0, ipv6=False, **kwargs):
+    """Start a mock server in a background thread of this process.
+
+    Returns the `MockServer`, which is ready to accept connections
+    as soon as this function returns. By default, it listens on a free
+    port on localhost: see its ``port`` and ``url``. Use it as a context
+    manager, or call ``close()`` when done. Other keyword arguments
+    (such as ``throttle``) are passed to `MockServer`.
+    """
+    server = MockServer(host, port, ipv6, rules, **kwargs)
+    # The socket is already listening, so clients can connect right away;
+    # they will be accepted as soon as the thread gets going.
+    server._serving_thread = threading.Thread(
+        target=server.serve_forever, kwargs={'poll_interval': 0.05},
+        daemon=True)
+    server._serving_thread.start()
+    return server
+
+
+def make_tls_context(cert_path, key_path=None):
+    # One context is shared by all connections, which is what makes
+    # session resumption work: TLS 1.3 session tickets and the TLS 1.2
+    # session cache are both enabled by default in OpenSSL, and are
+    # tied to the context.
+    import ssl
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(cert_path, key_path)
+    context.set_alpn_protocols(['http/1.1'])
+    return context
+
 
 class MockHandler(socketserver.StreamRequestHandler):
 
@@ -37,9 +250,14 @@ class MockHandler(socketserver.StreamRequestHandler):
         self._logger = getNextLogger('turq.connection')
         self._socket = self.request    # To reduce confusion with HTTP requests
         self._hconn = h11.Connection(our_role=h11.SERVER)
+        # Default throttling of response bodies, which rules can override.
+        self.bucket = (TokenBucket(self.server.throttle)
+                       if self.server.throttle else None)
 
     def handle(self):
         self._logger.info('new connection from %s', self.client_address[0])
+        if self.server.tls_context is not None and not self._start_tls():
+            return
         try:
             while True:
                 # pylint: disable=protected-access
@@ -47,7 +265,9 @@ class MockHandler(socketserver.StreamRequestHandler):
                 if isinstance(event, h11.Request):     # not `ConnectionClosed`
                     # `RulesContext` takes care of handling one complete
                     # request/response cycle.
-                    RulesContext(self.server.compiled_rules, self)._run(event)
+                    with self.server.exchange():
+                        RulesContext(self.server.compiled_rules,
+                                     self)._run(event)
                 self._logger.debug('states: %r', self._hconn.states)
                 if self._hconn.states == {h11.CLIENT: h11.DONE,
                                           h11.SERVER: h11.DONE}:
@@ -63,6 +283,31 @@ class MockHandler(socketserver.StreamRequestHandler):
             if self._hconn.our_state in [h11.SEND_RESPONSE, h11.IDLE]:
                 self._send_fatal_error(e)
 
+    def _start_tls(self):
+        # The handshake is done here, in the connection's own thread,
+        # so that slow or broken clients don't hold up the accept loop.
+        try:
+            self._socket = self.server.tls_context.wrap_socket(
+                self._socket, server_side=True)
+        except (OSError, ValueError) as e:
+            self._logger.error('TLS handshake failed: %s', e)
+            return False
+        self._logger.debug('TLS established: %s, session %s',
+                           self._socket.version(),
+                           'reused' if self._socket.session_reused else 'new')
+        return True
+
+    def finish(self):
+        super().finish()
+        if self._socket is not self.request:        # Wrapped with TLS
+            self._socket.close()
+
+    def reset_connection(self):
+        # Make closing the socket send a TCP RST instead of the usual FIN,
+        # so the client knows the response is broken.
+        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER,
+                                struct.pack('ii', 1, 0))
+
     @property
     def our_state(self):
         return self._hconn.our_state
@@ -80,8 +325,11 @@ class MockHandler(socketserver.StreamRequestHandler):
                 return event
 
     def send_event(self, event):
-        data = self._hconn.send(event)
-        self._socket.sendall(data)
+        if isinstance(event, h11.Data) and len(event.data) >= PASSTHROUGH_SIZE:
+            for data in self._hconn.send_with_data_passthrough(event):
+                self._socket.sendall(data)
+        else:
+            self._socket.sendall(self._hconn.send(event))
 
     def send_raw(self, data):
         self._socket.sendall(data)
@@ -0,0 +1,202 @@
+# Recording of exchanges handled by the mock server, and replaying them.
+#
+# A recording is an append-only file of records, one per exchange:
+#
+#   - a fixed-size header (see `RECORD_HEADER`) with the SHA-1 digest
+#     of the request body and the lengths of the three following parts;
+#   - the request head: request line and headers, like in HTTP/1.1;
+#   - the response head: status code, reason phrase, and headers;
+#   - the response body.
+#
+# Request bodies are not stored, only their digests, which is enough
+# to tell requests apart when replaying. For replaying, the file is
+# memory-mapped, and only a compact index is kept in memory.
+
+import hashlib
+import mmap
+import os
+import shutil
+import struct
+import tempfile
+import threading
+
+from turq.util.text import force_bytes
+
+
+FILE_MAGIC = b'TURQREC1\n'
+RECORD_HEADER = struct.Struct('>20sIII')
+
+# While a response is being sent, its body is kept for recording
+# in memory up to this size, and in a temporary file beyond it.
+SPOOL_SIZE = 1024 * 1024
+
+
+class Recorder:
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'ab')
+        self._lock = threading.Lock()
+        if self._file.tell() == 0:
+            self._file.write(FILE_MAGIC)
+            self._file.flush()
+
+    @staticmethod
+    def new_body():
+        # A file to write the response body to as it is sent,
+        # to be passed to `record` afterwards.
+        return tempfile.SpooledTemporaryFile(SPOOL_SIZE)
+
+    def record(self, request, body_digest, status_code, reason, headers,
+               body_file):
+        request_head = _encode_head('%s %s' % (request.method,
+                                               request.target),
+                                    request.raw_headers)
+        response_head = _encode_head('%d %s' % (status_code, reason),
+                                     headers)
+        body_len = body_file.seek(0, os.SEEK_END)
+        body_file.seek(0)
+        # The whole record is written under the lock, so that concurrent
+        # connections can't interleave their records.
+        with self._lock:
+            self._file.write(RECORD_HEADER.pack(body_digest,
+                                                len(request_head),
+                                                len(response_head), body_len))
+            self._file.write(request_head)
+            self._file.write(response_head)
+            shutil.copyfileobj(body_file, self._file)
+            self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+class Recording:
+
+    """A recording opened for replay.
+
+    Requests are matched by method, target, the values of `match_headers`
+    (if any), and, if `match_body` is true, the body. If the same request
+    was recorded several times, the latest response wins.
+    """
+
+    def __init__(self, path, match_headers=(), match_body=True):
+        self.path = path
+        self.match_headers = [name.lower() for name in match_headers]
+        self.match_body = match_body
+        self._index = {}
+        self._indexed = len(FILE_MAGIC)     # Where the next record starts
+        self._map = self._map_file()
+        self._index_new_records()
+
+    def __len__(self):
+        return len(self._index)
+
+    def _map_file(self):
+        with open(self.path, 'rb') as f:
+            if f.read(len(FILE_MAGIC)) != FILE_MAGIC:
+                raise ValueError('%s is not a Turq recording' % self.path)
+            # The file can't be empty (it has the magic),
+            # so it can always be mapped.
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def refresh(self):
+        """Pick up records appended to the file since it was indexed."""
+        # Lookups may run meanwhile. They see either the old mapping,
+        # which stays valid, or the new one, which is in place before
+        # any offsets into the appended part are indexed.
+        self._map = self._map_file()
+        self._index_new_records()
+
+    def _index_new_records(self):
+        # Keys are digests rather than tuples of strings, to keep the index
+        # small even with millions of records. Only the request heads are
+        # touched here; response bodies stay on disk until requested.
+        offset = self._indexed
+        size = len(self._map)
+        while offset + RECORD_HEADER.size <= size:
+            (body_digest, request_head_len, response_head_len, body_len) = \
+                RECORD_HEADER.unpack_from(self._map, offset)
+            start = offset + RECORD_HEADER.size
+            end = start + request_head_len + response_head_len + body_len
+            if end > size:          # Truncated record at the end
+                break
+            (request_line, headers) = \
+                _decode_head(self._map[start:(start + request_head_len)])
+            (method, target) = request_line.split(' ', 1)
+            key = self._key(method, target, headers, body_digest)
+            self._index[key] = offset
+            offset = end
+        self._indexed = offset
+
+    def _key(self, method, target, headers, body_digest):
+        h = hashlib.sha1()
+        h.update(('%s %s\n' % (method, target)).encode('iso-8859-1'))
+        headers = [(name.lower(), value) for (name, value) in headers]
+        for wanted in self.match_headers:
+            value = next((value for (name, value) in headers
+                          if name == wanted), '')
+            h.update(('%s: %s\n' % (wanted, value)).encode('iso-8859-1'))
+        if self.match_body:
+            h.update(body_digest)
+        return h.digest()
+
+    def lookup(self, method, target, headers, body_digest):
+        """Find the response to a request.
+
+        Returns a tuple of status code, reason phrase, headers, and body,
+        or `None` if there is no such request in the recording.
+        The body is a :class:`memoryview` of the mapped file.
+        """
+        offset = self._index.get(self._key(method, target, headers,
+                                           body_digest))
+        if offset is None:
+            return None
+        (_, request_head_len, response_head_len, body_len) = \
+            RECORD_HEADER.unpack_from(self._map, offset)
+        start = offset + RECORD_HEADER.size + request_head_len
+        (status_line, headers) = \
+            _decode_head(self._map[start:(start + response_head_len)])
+        (status_code, reason) = status_line.split(' ', 1)
+        start += response_head_len
+        body = memoryview(self._map)[start:(start + body_len)]
+        return (int(status_code), reason, headers, body)
+
+
+_recordings = {}
+_lock = threading.Lock()
+
+
+def open_recording(path, match_headers=(), match_body=True):
+    # Rules run anew for every request, so keep recordings open
+    # rather than reindexing them every time. But if the file has changed,
+    # pick up the changes. Usually it has just been appended to
+    # (e.g. by ``--record`` into the same file), and only the new records
+    # need indexing. If it has been replaced or truncated, reopen it.
+    key = (path, tuple(match_headers), match_body)
+    st = os.stat(path)
+    version = (st.st_ino, st.st_size, st.st_mtime_ns)
+    with _lock:
+        cached = _recordings.get(key)
+        if cached is None or cached[0][0] != st.st_ino or \
+                cached[0][1] > st.st_size:
+            # Requests that are still being served from the old `Recording`
+            # keep it (and its mapping) alive until they're done.
+            cached = (version, Recording(path, match_headers, match_body))
+            _recordings[key] = cached
+        elif cached[0] != version:
+            cached[1].refresh()
+            cached = _recordings[key] = (version, cached[1])
+        return cached[1]
+
+
+def _encode_head(first_line, headers):
+    lines = [first_line] + ['%s: %s' % (name, value)
+                            for (name, value) in headers]
+    return force_bytes('\r\n'.join(lines) + '\r\n')
+
+
+def _decode_head(data):
+    [first_line, *lines] = data.decode('iso-8859-1').split('\r\n')[:-1]
+    headers = [tuple(line.split(': ', 1)) for line in lines]
+    return (first_line, headers)
@@ -1,32 +1,155 @@
 # pylint: disable=protected-access
 
-import cgi
+import ast
+import builtins
+import collections.abc
 import contextlib
 import gzip
+import hashlib
 import io
+import itertools
 import json
 import logging
+import math
+import operator
 import random
 import re
 import socket
-import ssl
+import sys
+import threading
 import time
 import traceback
-from urllib.parse import parse_qs, urlparse
+from urllib.parse import parse_qs, unquote, urlparse
 import wsgiref.headers
+import zlib
 
-import dominate
-import dominate.tags as H
 import h11
 
+from turq.capture import BODY_PREFIX_SIZE
+from turq.recording import open_recording
+from turq.static import directory_index
 from turq.util.http import (KNOWN_METHODS, date, default_reason,
-                            error_explanation, nice_header_name)
+                            error_explanation, nice_header_name,
+                            parse_header)
+from turq.util.lazy import LazyModule
 from turq.util.logging import getNextLogger
+from turq.util.multipart import MultipartParser
+from turq.util.payload import (coalesce, lorem_chunks, random_chunks,
+                               repeat_chunks)
 from turq.util.text import ellipsize, force_bytes, lorem_ipsum
+from turq.util.throttle import TokenBucket, shared_bucket
+from turq.util.watchdog import WatchdogTimeout
 
 
 RULES_FILENAME = '<rules>'
 
+# What `body` sends as it is, rather than as an iterable of pieces.
+BODY_TYPES = (str, bytes, bytearray, memoryview)
+
+# Standard normal quantile for the 99th percentile.
+Z_99 = 2.3263478740408408
+
+# Request headers that distinguish otherwise identical requests
+# for ``forward(..., coalesce=True)``.
+COALESCE_HEADERS = ['Accept', 'Accept-Encoding', 'Accept-Language',
+                    'Authorization', 'Cookie']
+
+# Dominate is only needed by rules that build HTML, so don't make
+# every Turq instance pay for importing it.
+H = LazyModule('dominate.tags')
+
+
+class _PerThread(threading.local):
+
+    # The global `random` generator is shared by all threads, so they would
+    # contend for it on free-threaded Python. Each thread gets its own,
+    # seeded from `os.urandom`.
+
+    def __init__(self):
+        super().__init__()
+        self.random = random.Random()
+        self.scope = None       # Of the rules running now (see `_SetupBuiltins`)
+
+
+_per_thread = _PerThread()
+
+
+class Rules:
+
+    # Rules code ready to run. Everything derived from the rules source
+    # is prepared here, before the rules are installed, so that installing
+    # them is a single assignment, and requests that are already running
+    # can finish on the old rules undisturbed.
+
+    def __init__(self, source):
+        self.source = source
+        (self.code, setup_code) = _compile_rules(source)
+        self.json_cache = {}        # See `RulesContext.json`
+        # Names defined by the setup code are served to every request
+        # as if they were builtins, so they don't have to be copied
+        # into each request's scope.
+        self.builtins = None
+        if setup_code is not None:
+            self.builtins = dict(builtins.__dict__,
+                                 **_run_setup(setup_code), SETUP=False)
+
+
+class RulesSetupError(Exception):
+
+    pass
+
+
+def _compile_rules(source):
+    # Split out top-level ``if SETUP:`` blocks (without ``else``),
+    # which are to be run once, when the rules are installed.
+    if 'SETUP' not in source:           # Fast path for most rules
+        return (compile(source, RULES_FILENAME, 'exec'), None)
+    tree = ast.parse(source, RULES_FILENAME)
+    setup = [node for node in tree.body
+             if isinstance(node, ast.If) and not node.orelse and
+             isinstance(node.test, ast.Name) and node.test.id == 'SETUP']
+    tree.body = [node for node in tree.body if node not in setup]
+    code = compile(tree, RULES_FILENAME, 'exec')
+    if not setup:
+        return (code, None)
+    setup_tree = ast.Module(
+        body=[stmt for node in setup for stmt in node.body], type_ignores=[])
+    return (code, compile(setup_tree, RULES_FILENAME, 'exec'))
+
+
+class _SetupBuiltins(dict):
+
+    # Builtins for functions defined by the setup code. Their globals are
+    # the setup namespace, which never gets the names of any request,
+    # so names not found there are looked up in the rules scope
+    # of the request that is running in this thread (if any).
+    # This only works because the builtins are not an exact `dict`,
+    # which makes Python look names up with `__getitem__`.
+
+    def __missing__(self, name):
+        scope = _per_thread.scope
+        if scope is None:
+            raise KeyError(name)
+        return scope[name]
+
+
+def _run_setup(code):
+    namespace = {'SETUP': True,
+                 '__builtins__': _SetupBuiltins(builtins.__dict__)}
+    try:
+        exec(code, namespace)               # pylint: disable=exec-used
+    except Exception as exc:
+        [lineno, *_] = [lineno
+                        for (filename, lineno, _, _)
+                        in reversed(traceback.extract_tb(exc.__traceback__))
+                        if filename == RULES_FILENAME]
+        message = 'error in setup, line %d: %s' % (lineno, exc)
+        raise RulesSetupError(message) from exc
+    # Functions defined in setup keep `namespace` as their globals,
+    # so leave it alone.
+    return {name: value for (name, value) in namespace.items()
+            if name not in ['__builtins__', 'SETUP']}
+
 
 class RulesContext:
 
@@ -40,10 +163,17 @@ class RulesContext:
 
     # pylint: disable=attribute-defined-outside-init
 
-    def __init__(self, code, handler):
-        self._code = code
+    def __init__(self, rules, handler):
+        self._rules = rules
+        self._code = rules.code
         self._handler = handler
         self._logger = getNextLogger('turq.request')
+        self._bucket = handler.bucket
+        self._recorder = handler.server.recorder
+        self._capture = handler.server.capture
+        self._live = handler.server.live
+        self._watchdog = handler.server.watchdog
+        self.state = handler.server.state
 
     def _run(self, event):
         self.request = Request(
@@ -52,24 +182,94 @@ class RulesContext:
         )
         self._logger.info('> %s', ellipsize(self.request.line, 100))
         self._log_headers(self.request.raw_headers)
+        self._started = time.monotonic()
+        self._received_at = time.time()
+        self._delay_until = None
         self._response = Response()
+        # What actually went out, for `_record`.
+        self._sent = None
+        self._sent_body = (self._recorder.new_body() if self._recorder
+                           else None)
+        # What went out, for `_capture_exchange` and `_publish`.
+        self._sent_prefix = b''
+        self._sent_size = 0
         self._scope = self._build_scope()
+        guard = (contextlib.nullcontext() if self._watchdog is None
+                 else self._watchdog.guard())
+        outer_scope = _per_thread.scope
+        _per_thread.scope = self._scope
         try:
-            exec(self._code, self._scope)        # pylint: disable=exec-used
+            with guard:
+                exec(self._code, self._scope)    # pylint: disable=exec-used
         except SkipRemainingRules:
             pass
+        except WatchdogTimeout as exc:
+            self._log_rules_error(exc)
+            if self._handler.our_state is h11.SEND_RESPONSE:
+                self._response = Response()
+                self.error(500)
+            else:
+                # Part of the response is already out, and we can't tell
+                # how much. All we can do is give up on the connection.
+                self._handler.reset_connection()
+                self._record()          # Just to release the body
+                return
         except Exception as exc:
             self._log_rules_error(exc)
             if self._handler.our_state is h11.SEND_RESPONSE:
                 # We can still replace the response with a 500.
                 self._response = Response()
                 self.error(500)
+        finally:
+            _per_thread.scope = outer_scope
 
         # Depending on the rules, at this point the request body may or may not
         # have been received, and the response may or may not have been sent.
         # We need to make sure everything is flushed.
         self._ensure_request_received()
         self.flush()
+        self._record()
+        self._capture_exchange()
+        self._publish()
+
+    def _record(self):
+        body = self._sent_body
+        if body is None:
+            return
+        self._sent_body = None
+        with body:
+            if self._sent is not None and \
+                    self._handler.our_state in [h11.DONE, h11.MUST_CLOSE]:
+                (status_code, reason, headers) = self._sent
+                self._recorder.record(self.request, self._body_digest(),
+                                      status_code, reason, headers, body)
+
+    def _capture_exchange(self):
+        if self._capture is None or self._sent is None:
+            return
+        (status_code, reason, headers) = self._sent
+        request_body = self.request._body
+        self._capture.add(
+            self._received_at, self._handler.client_address[0],
+            self.request.method, self.request.target, self.request.raw_headers,
+            None if request_body is None else request_body[:BODY_PREFIX_SIZE],
+            None if request_body is None else len(request_body),
+            status_code, reason, headers, self._sent_prefix, self._sent_size)
+
+    def _publish(self):
+        if self._sent is None:
+            return
+        (status_code, reason, _) = self._sent
+        self._live.publish(
+            self._received_at, self._handler.client_address[0],
+            self.request.method, self.request.target, status_code, reason,
+            self._sent_size, time.monotonic() - self._started)
+
+    def _body_digest(self):
+        if self.request._body_digest is None:
+            self.request._body_digest = \
+                hashlib.sha1(self.request.body).digest()
+        return self.request._body_digest
 
     def _log_headers(self, headers):
         for (name, value) in headers:
@@ -88,15 +288,22 @@ class RulesContext:
         # ...utility functions
         for func in [lorem_ipsum, time.sleep]:
             scope[func.__name__] = func
+        # ...and whatever the setup code defined.
+        if self._rules.builtins is not None:
+            scope['__builtins__'] = self._rules.builtins
         return scope
 
     def _log_rules_error(self, exc):
         # Extract the rules line number where the error happened.
-        [lineno, *_] = [lineno
-                        for (filename, lineno, _, _)
-                        in reversed(traceback.extract_tb(exc.__traceback__))
-                        if filename == RULES_FILENAME]
-        self._logger.error('error in rules, line %d: %s', lineno, exc)
+        # (A `WatchdogTimeout` may arrive just after the rules finished.)
+        linenos = [lineno
+                   for (filename, lineno, _, _)
+                   in reversed(traceback.extract_tb(exc.__traceback__))
+                   if filename == RULES_FILENAME]
+        if linenos:
+            self._logger.error('error in rules, line %d: %s', linenos[0], exc)
+        else:
+            self._logger.error('error in rules: %s', exc)
         self._logger.debug('details of this error:', exc_info=True)
 
     def _ensure_request_received(self):
@@ -105,6 +312,7 @@ class RulesContext:
 
     def flush(self, body_too=True):
         if self._handler.our_state is h11.SEND_RESPONSE:
+            self._wait_for_delay()
             self._send_response()
             # Clear the list of response headers: from this point on,
             # any headers added will be sent in the trailer part.
@@ -112,26 +320,50 @@ class RulesContext:
         if body_too and self._handler.our_state is h11.SEND_BODY:
             self._send_body()
 
-    def _receive_body(self):
+    def _receive_body(self, sink=None):
+        # If `sink` is given, the body is passed to it piece by piece
+        # instead of being stored, and only its digest is kept.
         chunks = []
+        digest = hashlib.sha1()
+        size = 0
         while True:
             event = self._handler.receive_event()
             if isinstance(event, h11.Data):
-                chunks.append(event.data)
+                size += len(event.data)
+                if sink is None:
+                    chunks.append(event.data)
+                else:
+                    digest.update(event.data)
+                    sink(event.data)
             elif isinstance(event, h11.EndOfMessage):
-                self.request._body = b''.join(chunks)
-                self._logger.debug('received request body: %d bytes',
-                                   len(self.request._body))
+                if sink is None:
+                    self.request._body = b''.join(chunks)
+                else:
+                    self.request._body_digest = digest.digest()
+                    self.request._body_streamed = True
+                self._logger.debug('received request body: %d bytes', size)
                 # Add any trailer part to the main headers list
                 trailer = _decode_headers(event.headers)
                 self._log_headers(trailer)
                 self.request.raw_headers += trailer
                 break
 
+    def _wait_for_delay(self):
+        if self._delay_until is not None:
+            remaining = self._delay_until - time.monotonic()
+            if remaining > 0:
+                self._logger.debug('delaying response by %.3f seconds',
+                                   remaining)
+                time.sleep(remaining)
+            self._delay_until = None
+
     def _send_response(self, interim=False):
         self._response.finalize()
         self._logger.info('< %s', self._response.status_line)
         self._log_headers(self._response.raw_headers)
+        if not interim:
+            self._sent = (self._response.status_code, self._response.reason,
+                          list(self._response.raw_headers))
         cls = h11.InformationalResponse if interim else h11.Response
         self._handler.send_event(cls(
             http_version=self._response.http_version,
@@ -141,9 +373,20 @@ class RulesContext:
         ))
 
     def _send_body(self):
-        if self._response.body:
-            self.chunk(self._response.body)
+        body = self._response.body
+        if isinstance(body, Generated):
+            if self.method == 'HEAD':     # Don't bother generating
+                self._logger.debug('not generating response body '
+                                   'because request was HEAD')
+                self._response.body = None
+            else:
+                for data in body:
+                    self.chunk(data)
+        elif body:
+            self.chunk(body)
         self._log_headers(self._response.raw_headers)
+        if self._sent is not None:      # Trailer part
+            self._sent[2].extend(self._response.raw_headers)
         self._handler.send_event(h11.EndOfMessage(
             headers=_encode_headers(self._response.raw_headers),
         ))
@@ -174,10 +417,30 @@ class RulesContext:
     def delete_header(self, name):
         del self._response.headers[name]
 
-    def body(self, data):
+    def body(self, data, coalesce_size=None):
+        # Besides bytes and str, `data` can be an iterable (e.g. generator)
+        # of them. It is consumed only as the response is sent, one chunk
+        # per piece, or joined into chunks of about `coalesce_size` bytes.
         if hasattr(data, 'read'):       # files
             data = data.read()
-        self._response.body = force_bytes(data, 'utf-8')
+        if isinstance(data, BODY_TYPES):
+            self._response.body = force_bytes(data, 'utf-8')
+            return
+        if isinstance(data, collections.abc.Mapping) or \
+                not isinstance(data, collections.abc.Iterable):
+            raise TypeError('body() needs bytes, str, or an iterable of them, '
+                            'not %s (use json() to send objects as JSON)'
+                            % type(data).__name__)
+        if isinstance(data, collections.abc.Sequence):
+            # Pieces of a generator can only be checked as it is consumed,
+            # but these can be checked before the response starts.
+            for piece in data:
+                _check_body_piece(piece)
+        pieces = (force_bytes(_check_body_piece(piece), 'utf-8')
+                  for piece in data)
+        if coalesce_size:
+            pieces = coalesce(pieces, coalesce_size)
+        self._response.body = Generated(pieces)
 
     def chunk(self, data):
         self.flush(body_too=False)
@@ -191,11 +454,62 @@ class RulesContext:
                                'because request was HEAD', len(data))
         else:
             self._logger.debug('sending %d bytes of response body', len(data))
-            self._handler.send_event(h11.Data(data=force_bytes(data)))
+            self._send_data(force_bytes(data))
+
+    def _send_data(self, data):
+        if self._sent_body is not None:
+            self._sent_body.write(data)
+        if self._capture is not None and \
+                len(self._sent_prefix) < BODY_PREFIX_SIZE:
+            self._sent_prefix += \
+                bytes(data[:BODY_PREFIX_SIZE - len(self._sent_prefix)])
+        self._sent_size += len(data)
+        if self._bucket is None:
+            self._handler.send_event(h11.Data(data=data))
+        else:
+            for piece in self._bucket.pieces(data):
+                self._handler.send_event(h11.Data(data=piece))
+
+    def throttle(self, rate, shared=False):
+        # Limit the response body to `rate` bytes per second. By default,
+        # the limit applies to this connection; with `shared`, all responses
+        # throttled with `shared` at this rate split it between them.
+        if not rate:
+            self._bucket = None
+        elif shared:
+            self._bucket = shared_bucket(rate)
+        else:
+            self._bucket = TokenBucket(rate)
+
+    def random_body(self, size, seed=None):
+        self._generate(random_chunks(size, seed), size,
+                       'application/octet-stream')
+
+    def lorem_body(self, size, seed=None):
+        self._generate(lorem_chunks(size, seed), size,
+                       'text/plain; charset=utf-8')
+
+    def repeat_body(self, pattern, size):
+        self._generate(repeat_chunks(pattern, size), size,
+                       'application/octet-stream')
+
+    def _generate(self, chunks, size, content_type):
+        # The body is generated piece by piece as it is sent,
+        # so it can be much bigger than the available memory.
+        size = operator.index(size)     # Not a float, for example
+        if size < 0:
+            raise ValueError('body size cannot be negative: %r' % size)
+        if 'Content-Type' not in self._response.headers:
+            self.header('Content-Type', content_type)
+        self.header('Content-Length', str(size))
+        self._response.body = Generated(chunks, size)
 
     def content_length(self):
-        self._response.headers['Content-Length'] = \
-            str(len(self._response.body))
+        body = self._response.body
+        if isinstance(body, Generated) and body.size is None:
+            raise ValueError('content_length() cannot be used with a body '
+                             'whose size is not known until it is sent')
+        self._response.headers['Content-Length'] = str(len(body))
 
     @contextlib.contextmanager
     def interim(self):
@@ -206,11 +520,97 @@ class RulesContext:
         self._send_response(interim=True)
         self._response = main_response
 
-    def forward(self, hostname, port, target, tls=None):
+    def forward(self, hostname, port, target, tls=None, cache=False,
+                coalesce=False):    # pylint: disable=redefined-outer-name
+        # With `cache`, upstream responses are stored and reused
+        # as an HTTP cache would (see `turq.cache`). With `coalesce`,
+        # concurrent identical GET and HEAD requests (by target and
+        # the `COALESCE_HEADERS`, or the header names given instead)
+        # share a single upstream request.
         self._ensure_request_received()     # Get the trailer part, if any
+        if tls is None:
+            tls = (port == 443)
+
+        def fetch():
+            if not cache:
+                return (self._forward(hostname, port, target, tls), None)
+            return self._handler.server.forward_cache.fetch(
+                (hostname, port, tls, self.method, target), self.request,
+                lambda headers: self._forward(hostname, port, target, tls,
+                                              headers))
+
+        if coalesce and self.method in ['GET', 'HEAD']:
+            names = COALESCE_HEADERS if coalesce is True else coalesce
+            key = (hostname, port, tls, self.method, target,
+                   tuple(tuple(self.request.headers.get_all(name))
+                         for name in names))
+            ((response, outcome), shared) = \
+                self._handler.server.single_flight.run(key, fetch)
+            if shared:
+                self._logger.debug('coalesced with an identical '
+                                   'upstream request')
+            # The same response goes to all coalesced requests,
+            # and the rules may yet change it.
+            self._response = response.copy()
+        else:
+            (self._response, outcome) = fetch()
+        if outcome is None:
+            self._logger.debug('upstream response: %s',
+                               self._response.status_line)
+        else:
+            self._logger.debug('upstream response (cache %s): %s', outcome,
+                               self._response.status_line)
+
+    def _forward(self, hostname, port, target, tls, headers=None):
         self._logger.debug('forwarding to %s port %d', hostname, port)
-        self._response = forward(self.request, hostname, port, target, tls)
-        self._logger.debug('upstream response: %s', self._response.status_line)
+        return forward(self.request, hostname, port, target, tls, headers)
+
+    def replay(self, path, match_headers=(), match_body=True):
+        # Respond from a recording made with ``--record``, if it has
+        # a matching request. The body is served straight from the file.
+        recording = open_recording(path, match_headers, match_body)
+        found = recording.lookup(self.method, self.target,
+                                 self.request.raw_headers,
+                                 self._body_digest() if match_body else None)
+        if found is None:
+            self._logger.debug('no matching request in %s', path)
+            return False
+        (status_code, reason, headers, data) = found
+        self._logger.debug('replaying response from %s', path)
+        self._response = Response()
+        self.status(status_code, reason)
+        # The recorded ``Date`` would be misleading.
+        self._response.raw_headers[:] = [(name, value)
+                                         for (name, value) in headers
+                                         if name.lower() != 'date']
+        self._response.body = data
+        return True
+
+    def serve_dir(self, root, prefix='/'):
+        # Respond with a file from the `root` directory, if the path
+        # starts with `prefix` and the rest of it names an existing file.
+        # The prefix matches whole segments: ``/api`` matches ``/api/x``
+        # but not ``/apix``.
+        prefix = prefix.rstrip('/')
+        if self.method not in ['GET', 'HEAD'] or not (
+                self.path == prefix or self.path.startswith(prefix + '/')):
+            return False
+        found = directory_index(root).open(unquote(self.path[len(prefix):]))
+        if found is None:
+            self._logger.debug('no such file in %s', root)
+            return False
+        (entry, contents) = found
+        self.header('ETag', entry.etag)
+        self.header('Last-Modified', entry.last_modified)
+        if_none_match = self.request.headers.get('If-None-Match', '')
+        if entry.etag in if_none_match or if_none_match.strip() == '*':
+            self.status(304)
+            self._response.body = b''
+        else:
+            self.header('Content-Type', entry.content_type)
+            self.header('Content-Length', str(entry.size))
+            self._response.body = contents
+        return True
 
     def text(self, content):
         self.header('Content-Type', 'text/plain; charset=utf-8')
@@ -220,18 +620,41 @@ class RulesContext:
         self.status(code)
         self.text('Error! %s\r\n' % error_explanation(code))
 
-    def json(self, obj, jsonp=False):
-        data = json.dumps(obj)
-        if jsonp and self.request.query.get('callback'):
+    def json(self, obj, jsonp=False, stream=False, cache=False):
+        # With `stream`, the JSON is encoded bit by bit as it is sent,
+        # so it never exists in memory as a whole. With `cache`, it is
+        # encoded once and reused for later requests that reach this same
+        # call in the rules, until new rules are installed. This is meant
+        # for big constant fixtures defined right in the rules. The cache
+        # starts cold with new rules, because the call sites are only known
+        # once requests reach them. Setup code can encode ahead instead.
+        if cache:
+            caller = sys._getframe(1)
+            key = (caller.f_code, caller.f_lasti)
+            data = self._rules.json_cache.get(key)
+            if data is None:
+                # Threads that get here at once all encode it, and the last
+                # one wins. That's harmless, and cheaper than a lock.
+                data = json.dumps(obj).encode()
+                self._rules.json_cache[key] = data
+            pieces = [data]
+        elif stream:
+            pieces = json.JSONEncoder().iterencode(obj)
+        else:
+            pieces = [json.dumps(obj)]
+        callback = self.request.query.get('callback') if jsonp else None
+        if callback:
             self.header('Content-Type', 'application/javascript')
-            # http://timelessrepo.com/json-isnt-a-javascript-subset
-            data = (data.
-                    replace('\u2028', '\\u2028').
-                    replace('\u2029', '\\u2029'))
-            self.body('%s(%s);' % (self.request.query['callback'], data))
+            pieces = itertools.chain(['%s(' % callback],
+                                     map(_escape_for_javascript, pieces),
+                                     [');'])
         else:
             self.header('Content-Type', 'application/json')
-            self.body(data)
+        if stream and not cache:
+            self._response.body = Generated(coalesce(pieces))
+        else:
+            self._response.body = b''.join(force_bytes(piece, 'utf-8')
+                                           for piece in pieces)
 
     def route(self, spec):
         # Convert our simplistic route format to a regex to match the path.
@@ -262,18 +685,35 @@ class RulesContext:
 
     @contextlib.contextmanager
     def _edit_html(self):
+        import dominate
         document = dominate.document(title='Hello world')
         with document:
             yield document
         self.header('Content-Type', 'text/html; charset=utf-8')
         self.body(document.render())
 
+    def delay(self, seconds=None, distribution='lognormal',
+              p50=None, p99=None):
+        # Unlike `sleep`, this doesn't block the rules: the response is held
+        # back just before sending, so any time spent in the rules (or in
+        # `forward`) counts towards the delay. Repeated calls add up.
+        # The connection's thread still sleeps for the rest of the delay
+        # (see `_wait_for_delay`), like it would in `sleep`.
+        if seconds is None:
+            seconds = _sample_delay(distribution, p50, p99)
+        self._logger.debug('response will be delayed by %.3f seconds', seconds)
+        self._delay_until = (self._delay_until or self._started) + seconds
+
     @staticmethod
     def maybe(p):
-        return random.random() < p
+        return _per_thread.random.random() < p
 
     def send_raw(self, data):
         self._logger.info('sending %d bytes of raw data', len(data))
+        if self._sent_body is not None:
+            # This is no longer HTTP, can't record.
+            self._sent_body.close()
+            self._sent_body = None
         self._handler.send_raw(force_bytes(data, 'utf-8'))
 
     def cors(self):
@@ -311,10 +751,17 @@ class RulesContext:
             raise SkipRemainingRules()
 
     def gzip(self):
-        buf = io.BytesIO()
-        with gzip.GzipFile(mode='wb', compresslevel=4, fileobj=buf) as f:
-            f.write(self._response.body)
-        self.body(buf.getvalue())
+        body = self._response.body
+        if isinstance(body, Generated):
+            # Compress it as it is generated. The compressed size
+            # is not known in advance, so it will be sent chunked.
+            self._response.body = Generated(_gzip_chunks(body))
+            del self._response.headers['Content-Length']
+        else:
+            buf = io.BytesIO()
+            with gzip.GzipFile(mode='wb', compresslevel=4, fileobj=buf) as f:
+                f.write(body)
+            self.body(buf.getvalue())
         self.add_header('Content-Encoding', 'gzip')
 
     def redirect(self, location, status=302):
@@ -323,6 +770,24 @@ class RulesContext:
         self.text('Please see %s\r\n' % location)
 
 
+class Generated:
+
+    # A response body that is generated while sending.
+    # Its `size` may be unknown in advance.
+
+    def __init__(self, chunks, size=None):
+        self.chunks = chunks
+        self.size = size
+
+    def __iter__(self):
+        return iter(self.chunks)
+
+    def __len__(self):
+        if self.size is None:
+            raise TypeError('size of this body is not known in advance')
+        return self.size
+
+
 class SkipRemainingRules(Exception):
 
     pass
@@ -341,6 +806,8 @@ class Request:
         self.raw_headers = headers
         self.headers = wsgiref.headers.Headers(self.raw_headers)
         self._body = None
+        self._body_digest = None
+        self._body_streamed = False
         self._json = None
         self._form = None
 
@@ -352,6 +819,9 @@ class Request:
     def body(self):
         # Request body is received lazily. This allows handling
         # finer aspects of the protocol, such as ``Expect: 100-continue``.
+        if self._body_streamed:
+            raise RuntimeError('request body was already parsed by '
+                               '`request.form` and is no longer available')
         if self._body is None:
             self._context._receive_body()
         return self._body
@@ -374,15 +844,29 @@ class Request:
         if self._form is None:
             try:
                 content_type = self.headers.get('Content-Type', '')
-                type_, params = cgi.parse_header(content_type)
+                type_, params = parse_header(content_type)
                 if type_.lower() == 'multipart/form-data':
-                    self._form = _parse_multipart(self.body, params)
+                    self._form = self._parse_multipart(params)
                 else:       # Assume URL-encoded
                     self._form = _single_values(parse_qs(self.body.decode()))
             except ValueError as exc:
                 self._context._logger.debug('cannot read form: %s', exc)
         return self._form
 
+    def _parse_multipart(self, params):
+        if 'boundary' not in params:
+            raise ValueError('no boundary in multipart Content-Type')
+        if self._body_streamed:             # A previous attempt failed
+            raise ValueError('body already consumed')
+        parser = MultipartParser(force_bytes(params['boundary']))
+        if self._body is None:
+            # Parse the body as it arrives, instead of receiving it whole.
+            # This way, even huge uploads don't take up memory.
+            self._context._receive_body(sink=parser.feed)
+        else:
+            parser.feed(self._body)
+        return parser.close()
+
 
 class Response:
 
@@ -409,6 +893,15 @@ class Response:
         if 200 <= self.status_code <= 499 and 'Date' not in self.headers:
             self.headers['Date'] = date()
 
+    def copy(self):
+        response = Response()
+        response.http_version = self.http_version
+        response.status_code = self.status_code
+        response.reason = self.reason
+        response.raw_headers[:] = self.raw_headers
+        response.body = self.body
+        return response
+
     @property
     def status_line(self):
         # Reconstructed status-line, for logging.
@@ -416,6 +909,33 @@ class Response:
                                   self.status_code, self.reason)
 
 
+def _check_body_piece(piece):
+    if not isinstance(piece, BODY_TYPES):
+        raise TypeError('body() needs an iterable of bytes or str, '
+                        'but got a piece of type %s' % type(piece).__name__)
+    return piece
+
+
+def _gzip_chunks(chunks):
+    # ``wbits=31`` means gzip format (with header and trailer).
+    compressor = zlib.compressobj(4, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def _escape_for_javascript(piece):
+    # http://timelessrepo.com/json-isnt-a-javascript-subset
+    # Cached pieces are bytes, which are ASCII-only anyway.
+    if isinstance(piece, str):
+        piece = (piece.
+                 replace('\u2028', '\\u2028').
+                 replace('\u2029', '\\u2029'))
+    return piece
+
+
 def _decode_headers(headers):
     # Header values can contain arbitrary bytes. Decode them from ISO-8859-1,
     # which is the historical encoding of HTTP. Decoding bytes from ISO-8859-1
@@ -430,12 +950,18 @@ def _encode_headers(headers):
             for (name, value) in headers]
 
 
-def _parse_multipart(body, params):
-    # Some ritual dance is required to get the `cgi` module work in 2017.
-    body = io.BytesIO(body)
-    params = {name: force_bytes(value) for (name, value) in params.items()}
-    parsed = _single_values(cgi.parse_multipart(body, params))
-    return {name: value.decode('utf-8') for (name, value) in parsed.items()}
+def _sample_delay(distribution, p50, p99):
+    if p50 is None or p99 is None:
+        raise ValueError('delay() needs either seconds or p50 and p99')
+    if not 0 < p50 <= p99:
+        raise ValueError('delay() needs 0 < p50 <= p99')
+    if distribution == 'lognormal':
+        sigma = (math.log(p99) - math.log(p50)) / Z_99
+        return _per_thread.random.lognormvariate(math.log(p50), sigma)
+    elif distribution == 'normal':
+        return max(0, _per_thread.random.gauss(p50, (p99 - p50) / Z_99))
+    else:
+        raise ValueError('unknown delay distribution: %r' % distribution)
 
 
 def _single_values(parsed_dict):
@@ -443,11 +969,14 @@ def _single_values(parsed_dict):
     return {name: value for name, (value, *_) in parsed_dict.items()}
 
 
-def forward(request, hostname, port, target, tls=None):
+def forward(request, hostname, port, target, tls=None, headers=None):
+    # `headers` replace those of `request`, e.g. to make it conditional.
     hconn = h11.Connection(our_role=h11.CLIENT)
     if tls is None:
         tls = (port == 443)
-    headers = _forward_headers(request.raw_headers, request.http_version,
+    if headers is None:
+        headers = request.raw_headers
+    headers = _forward_headers(headers, request.http_version,
                                also_exclude=['Host'])
     # RFC 7230 recommends that ``Host`` be the first header.
     headers.insert(0, ('Host', _generate_host_header(hostname, port, tls)))
@@ -457,6 +986,7 @@ def forward(request, hostname, port, target, tls=None):
 
     try:
         if tls:
+            import ssl
             # We intentionally ignore server certificates. In this context,
             # they are more likely to be a nuisance than a boon.
             ssl_context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
@@ -0,0 +1,155 @@
+# A key-value store that rules can use to keep state between requests,
+# such as counters, "fail the first 3 calls", or per-client sessions.
+# It is shared by all connections to a mock server, and survives
+# installing new rules.
+
+import threading
+import time
+
+
+MAX_KEYS = 10000
+
+# Keys are spread over this many independently locked stripes,
+# so that requests touching unrelated keys rarely wait for each other.
+STRIPES = 16
+
+_MISSING = object()
+
+
+class State:
+
+    # Every operation is atomic. Compound operations across several calls
+    # can be made atomic with ``with state.lock(key):``. The store holds
+    # at most `max_keys` keys; when a stripe is full, expired keys are
+    # dropped first, then the oldest ones.
+
+    def __init__(self, max_keys=MAX_KEYS, stripes=STRIPES):
+        self._stripes = [_Stripe(max(1, max_keys // stripes))
+                         for _ in range(stripes)]
+
+    def _stripe(self, key):
+        return self._stripes[hash(key) % len(self._stripes)]
+
+    def lock(self, key):
+        # The lock is reentrant, so other `state` methods can be called
+        # while holding it. It also guards every other key in its stripe,
+        # so don't hold it for long.
+        return self._stripe(key).lock
+
+    def get(self, key, default=None):
+        stripe = self._stripe(key)
+        with stripe.lock:
+            return stripe.get(key, default)
+
+    def set(self, key, value, ttl=None):
+        stripe = self._stripe(key)
+        with stripe.lock:
+            stripe.put(key, value, ttl)
+
+    def setdefault(self, key, value, ttl=None):
+        stripe = self._stripe(key)
+        with stripe.lock:
+            current = stripe.get(key, _MISSING)
+            if current is _MISSING:
+                stripe.put(key, value, ttl)
+                return value
+            return current
+
+    def delete(self, key):
+        stripe = self._stripe(key)
+        with stripe.lock:
+            stripe.entries.pop(key, None)
+
+    def incr(self, key, delta=1, ttl=None):
+        # A missing (or expired) key counts as 0. `ttl` applies
+        # only when the key is created, so a counter with a TTL
+        # counts events within a fixed window.
+        stripe = self._stripe(key)
+        with stripe.lock:
+            entry = stripe.entry(key)
+            if entry is None:
+                value = delta
+                stripe.put(key, value, ttl)
+            else:
+                value = entry[0] + delta
+                stripe.entries[key] = (value, entry[1])
+            return value
+
+    def compare_and_set(self, key, expected, value, ttl=None):
+        # A missing key compares equal to `None`.
+        stripe = self._stripe(key)
+        with stripe.lock:
+            if stripe.get(key, None) != expected:
+                return False
+            stripe.put(key, value, ttl)
+            return True
+
+    def ttl(self, key):
+        # Seconds until `key` expires, or `None` if it never does
+        # (or doesn't exist).
+        stripe = self._stripe(key)
+        with stripe.lock:
+            entry = stripe.entry(key)
+            if entry is None or entry[1] is None:
+                return None
+            return entry[1] - time.monotonic()
+
+    def clear(self):
+        for stripe in self._stripes:
+            with stripe.lock:
+                stripe.entries.clear()
+
+    def items(self):
+        # A snapshot of all live keys, as ``(key, value, ttl)`` triples.
+        now = time.monotonic()
+        result = []
+        for stripe in self._stripes:
+            with stripe.lock:
+                stripe.purge(now)
+                result.extend(
+                    (key, value, None if expires is None else expires - now)
+                    for (key, (value, expires)) in stripe.entries.items())
+        return result
+
+    def __contains__(self, key):
+        return self.get(key, _MISSING) is not _MISSING
+
+    def __len__(self):
+        return len(self.items())
+
+
+class _Stripe:
+
+    # Methods of this class must be called with `lock` held.
+
+    def __init__(self, max_keys):
+        self.lock = threading.RLock()
+        self.max_keys = max_keys
+        self.entries = {}       # key -> (value, expiry time or None)
+
+    def entry(self, key):
+        entry = self.entries.get(key)
+        if entry is not None and entry[1] is not None and \
+                entry[1] <= time.monotonic():
+            del self.entries[key]
+            entry = None
+        return entry
+
+    def get(self, key, default):
+        entry = self.entry(key)
+        return default if entry is None else entry[0]
+
+    def put(self, key, value, ttl):
+        expires = None if ttl is None else time.monotonic() + ttl
+        self.entries.pop(key, None)     # Re-inserting makes it the newest
+        if len(self.entries) >= self.max_keys:
+            self.purge(time.monotonic())
+        while len(self.entries) >= self.max_keys:
+            del self.entries[next(iter(self.entries))]
+        self.entries[key] = (value, expires)
+
+    def purge(self, now):
+        expired = [key for (key, (_, expires)) in self.entries.items()
+                   if expires is not None and expires <= now]
+        for key in expired:
+            del self.entries[key]
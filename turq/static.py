@@ -0,0 +1,124 @@
+# Serving trees of static files, such as fixtures for a mock API.
+
+import collections
+import email.utils
+import mimetypes
+import mmap
+import os
+import posixpath
+import threading
+import time
+
+
+Entry = collections.namedtuple('Entry', ['size', 'mtime', 'content_type',
+                                         'etag', 'last_modified'])
+
+
+class DirectoryIndex:
+
+    # The tree is scanned on the first lookup, so that later lookups
+    # don't touch the filesystem. To pick up changes, a file's metadata
+    # is checked when it's opened for serving (which we need to do anyway),
+    # and the whole tree is rescanned when a path is not found,
+    # but at most once every `rescan_interval` seconds.
+
+    rescan_interval = 1
+
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+        self._entries = {}
+        self._scanned = None            # `time.monotonic` of the last scan
+        # Only one thread scans at a time. Lookups don't need the lock,
+        # because a scan replaces `_entries` with a new dict.
+        self._scan_lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def scan(self):
+        with self._scan_lock:
+            self._scan()
+
+    def _rescan(self, scanned):
+        # `scanned` is the `_scanned` that the caller found too old.
+        # If it has changed by the time we get the lock, another thread
+        # has just rescanned, and the caller can use its results.
+        with self._scan_lock:
+            if self._scanned == scanned:
+                self._scan()
+
+    def _scan(self):
+        entries = {}
+        for (dirpath, _, filenames) in os.walk(self.root):
+            for filename in filenames:
+                fs_path = os.path.join(dirpath, filename)
+                try:
+                    st = os.stat(fs_path)
+                except OSError:         # Deleted in the meantime, etc.
+                    continue
+                rel_path = os.path.relpath(fs_path, self.root)
+                entries['/' + rel_path.replace(os.sep, '/')] = \
+                    _make_entry(fs_path, st)
+        self._entries = entries
+        self._scanned = time.monotonic()
+
+    def open(self, path):
+        """Find the file at `path` (relative to the root).
+
+        Returns a tuple of its :class:`Entry` and contents,
+        or `None` if there's no such file. Contents are memory-mapped,
+        so even huge files are not read into memory.
+        """
+        # A leading ``//`` would survive `normpath` and never match.
+        path = path.replace('\\', '/').lstrip('/')
+        path = posixpath.normpath('/' + path)       # Prevents traversal
+        scanned = self._scanned
+        entry = self._entries.get(path)
+        if entry is None and (scanned is None or
+                              time.monotonic() - scanned >=
+                              self.rescan_interval):
+            self._rescan(scanned)
+            entry = self._entries.get(path)
+        if entry is None:
+            return None
+        fs_path = os.path.join(self.root, *path.split('/'))
+        try:
+            f = open(fs_path, 'rb')
+        except OSError:
+            self._entries.pop(path, None)
+            return None
+        with f:
+            st = os.fstat(f.fileno())
+            if (st.st_size, st.st_mtime_ns) != (entry.size, entry.mtime):
+                entry = self._entries[path] = _make_entry(fs_path, st)
+            if entry.size == 0:         # Empty files can't be mapped
+                return (entry, b'')
+            contents = mmap.mmap(f.fileno(), entry.size,
+                                 access=mmap.ACCESS_READ)
+        return (entry, memoryview(contents))
+
+
+def _make_entry(fs_path, st):
+    (content_type, _) = mimetypes.guess_type(fs_path)
+    return Entry(
+        size=st.st_size,
+        mtime=st.st_mtime_ns,
+        content_type=content_type or 'application/octet-stream',
+        etag='"%x-%x"' % (st.st_mtime_ns, st.st_size),
+        last_modified=email.utils.formatdate(st.st_mtime, usegmt=True),
+    )
+
+
+_indexes = {}
+_lock = threading.Lock()
+
+
+def directory_index(root):
+    # Rules run anew for every request, so keep indexes around
+    # rather than rescanning every time. They are cheap to create;
+    # the scan happens later, without holding up other roots.
+    root = os.path.abspath(root)
+    with _lock:
+        if root not in _indexes:
+            _indexes[root] = DirectoryIndex(root)
+        return _indexes[root]
@@ -1,11 +1,9 @@
-from datetime import datetime
+import email.utils
 import http.server
 from ipaddress import IPv6Address
 import re
 import socket
 
-import werkzeug.http
-
 
 # https://www.iana.org/assignments/http-methods/http-methods.xhtml
 KNOWN_METHODS = ['ACL', 'BASELINE-CONTROL', 'BIND', 'CHECKIN', 'CHECKOUT',
@@ -18,6 +16,9 @@ KNOWN_METHODS = ['ACL', 'BASELINE-CONTROL', 'BIND', 'CHECKIN', 'CHECKOUT',
                  'UPDATEREDIRECTREF', 'VERSION-CONTROL']
 
 
+QUOTED_PAIR = re.compile(r'\\(.)')
+CACHE_DIRECTIVE = re.compile(r'([^\s,=]+)(=("(?:[^"\\]|\\.)*"|[^\s,]*))?')
+
 IPV4_REVERSE_DNS = re.compile(r'^' + r'([0-9]+)\.' * 4 + r'in-addr\.arpa\.?$',
                               flags=re.IGNORECASE)
 IPV6_REVERSE_DNS = re.compile(r'^' + r'([0-9a-f])\.' * 32 + r'ip6\.arpa\.?$',
@@ -38,7 +39,60 @@ def error_explanation(status_code):
 
 
 def date():
-    return werkzeug.http.http_date(datetime.utcnow())
+    return email.utils.formatdate(usegmt=True)
+
+
+def parse_header(value):
+    # "text/html; charset=utf-8" -> ('text/html', {'charset': 'utf-8'})
+    (main, *params) = _split_parameters(value)
+    parsed = {}
+    for param in params:
+        (name, _, param_value) = param.partition('=')
+        param_value = param_value.strip()
+        if len(param_value) >= 2 and param_value[0] == param_value[-1] == '"':
+            param_value = QUOTED_PAIR.sub(r'\1', param_value[1:-1])
+        parsed[name.strip().lower()] = param_value
+    return (main.strip(), parsed)
+
+
+def _split_parameters(value):
+    # Split on semicolons, except those inside quoted strings.
+    pieces = []
+    start = 0
+    in_quotes = False
+    i = 0
+    while i < len(value):
+        if in_quotes and value[i] == '\\':
+            i += 1                      # Skip the escaped character
+        elif value[i] == '"':
+            in_quotes = not in_quotes
+        elif value[i] == ';' and not in_quotes:
+            pieces.append(value[start:i])
+            start = i + 1
+        i += 1
+    pieces.append(value[start:])
+    return pieces[:1] + [piece for piece in pieces[1:] if piece.strip()]
+
+
+def parse_cache_control(values):
+    # ["max-age=60, must-revalidate"] -> {'max-age': '60',
+    #                                     'must-revalidate': None}
+    # Takes all values of the header, because it may be repeated.
+    parsed = {}
+    for value in values:
+        for (name, has_arg, arg) in CACHE_DIRECTIVE.findall(value):
+            if len(arg) >= 2 and arg[0] == arg[-1] == '"':
+                arg = QUOTED_PAIR.sub(r'\1', arg[1:-1])
+            parsed.setdefault(name.lower(), arg if has_arg else None)
+    return parsed
+
+
+def parse_date(value):
+    # HTTP-date -> POSIX timestamp, or `None` if invalid.
+    try:
+        return email.utils.parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError, IndexError):
+        return None
 
 
 def nice_header_name(name):
@@ -46,7 +100,7 @@ def nice_header_name(name):
     return '-'.join(word.capitalize() for word in name.split('-'))
 
 
-def guess_external_url(local_host, port):
+def guess_external_url(local_host, port, scheme='http'):
     """Return a URL that is most likely to route to `local_host` from outside.
 
     The point is that we may be running on a remote host from the user's
@@ -76,4 +130,4 @@ def guess_external_url(local_host, port):
         # removing the zone ID altogether. After all this is just a guess.
         local_host = '[%s]' % local_host.rsplit('%', 1)[0]
 
-    return 'http://%s:%d/' % (local_host, port)
+    return '%s://%s:%d/' % (scheme, local_host, port)
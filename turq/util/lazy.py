@@ -0,0 +1,20 @@
+import importlib
+
+
+class LazyModule:
+
+    # Stands in for a module that is imported on first attribute access.
+    # Used for heavy dependencies that most Turq instances never touch,
+    # to keep startup fast.
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+    def __repr__(self):
+        return '<lazy module %r>' % self._name
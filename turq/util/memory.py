@@ -0,0 +1,116 @@
+# Memory diagnostics for long-running Turq instances: counts of live
+# objects that should not pile up, and allocation sites from `tracemalloc`,
+# optionally compared to a baseline snapshot taken earlier.
+
+import gc
+import logging
+import os
+import threading
+import tracemalloc
+
+
+DEFAULT_LIMIT = 10
+
+_baseline = None
+_lock = threading.Lock()
+
+
+def object_counts():
+    # Objects that exist per request or per connection. If their counts
+    # keep growing while the mock is idle, something is holding on to them.
+    import turq.mock
+    import turq.rules
+    tracked = [turq.rules.RulesContext, turq.rules.Request,
+               turq.rules.Response, turq.mock.MockHandler]
+    counts = dict.fromkeys(tracked, 0)
+    for obj in gc.get_objects():
+        cls = type(obj)
+        if cls in counts:
+            counts[cls] += 1
+    counts = [(cls.__name__, count) for (cls, count) in counts.items()]
+    counts.append(('loggers', len(logging.Logger.manager.loggerDict)))
+    counts.append(('threads', threading.active_count()))
+    return counts
+
+
+def rss():
+    # Resident set size in bytes, or `None` if we can't tell.
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def start_tracing():
+    if not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+
+def stop_tracing():
+    global _baseline                    # pylint: disable=global-statement
+    with _lock:
+        _baseline = None
+    tracemalloc.stop()
+
+
+def take_baseline():
+    # Later reports will show what changed since this snapshot.
+    global _baseline                    # pylint: disable=global-statement
+    if not tracemalloc.is_tracing():
+        raise ValueError('tracemalloc is not started')
+    snapshot = _snapshot()
+    with _lock:
+        _baseline = snapshot
+
+
+def report(limit=DEFAULT_LIMIT):
+    lines = []
+    size = rss()
+    if size is not None:
+        lines.append('RSS: %s' % _format_size(size))
+    lines.append('')
+    lines.append('Live objects:')
+    for (name, count) in object_counts():
+        lines.append('  %-14s %d' % (name, count))
+    lines.append('')
+    if not tracemalloc.is_tracing():
+        lines.append('tracemalloc is not started.')
+        return '\n'.join(lines) + '\n'
+
+    (current, peak) = tracemalloc.get_traced_memory()
+    lines.append('Traced memory: %s (peak %s)' % (_format_size(current),
+                                                   _format_size(peak)))
+    snapshot = _snapshot()
+    with _lock:
+        baseline = _baseline
+    if baseline is None:
+        lines.append('Top allocation sites:')
+        for stat in snapshot.statistics('lineno')[:limit]:
+            lines.append('  %10s %8d blocks  %s' % (
+                _format_size(stat.size), stat.count, stat.traceback[0]))
+    else:
+        lines.append('Top changes since baseline:')
+        for stat in snapshot.compare_to(baseline, 'lineno')[:limit]:
+            lines.append('  %10s %+8d blocks  %s' % (
+                ('+' if stat.size_diff > 0 else '') +
+                _format_size(stat.size_diff),
+                stat.count_diff, stat.traceback[0]))
+    return '\n'.join(lines) + '\n'
+
+
+def _snapshot():
+    return tracemalloc.take_snapshot().filter_traces([
+        # Don't count our own bookkeeping.
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+        tracemalloc.Filter(False, '<unknown>'),
+    ])
+
+
+def _format_size(size):
+    for unit in ['B', 'KiB', 'MiB']:
+        if abs(size) < 1024:
+            return '%d %s' % (size, unit)
+        size /= 1024
+    return '%.1f GiB' % size
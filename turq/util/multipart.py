@@ -0,0 +1,188 @@
+# An incremental parser for ``multipart/form-data`` (RFC 7578).
+#
+# The body is fed to the parser as it arrives from the client,
+# so the whole body never has to be in memory. Files are spooled
+# to disk once they grow past `SPOOL_SIZE`.
+
+import tempfile
+
+from turq.util.http import parse_header
+
+
+MAX_PARTS = 1000
+MAX_FIELD_SIZE = 1024 * 1024            # Fields are kept in memory
+MAX_FILE_SIZE = 1024 * 1024 * 1024
+MAX_HEADERS_SIZE = 16 * 1024
+SPOOL_SIZE = 1024 * 1024
+
+
+class UploadedFile:
+
+    def __init__(self, filename, content_type, headers):
+        self.filename = filename
+        self.content_type = content_type
+        self.headers = headers
+        self.size = 0
+        self.file = tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE)
+
+    def read(self):
+        self.file.seek(0)
+        return self.file.read()
+
+    def __repr__(self):
+        return '<UploadedFile %r (%s, %d bytes)>' % (
+            self.filename, self.content_type, self.size)
+
+
+class MultipartParser:
+
+    """Parse a ``multipart/form-data`` body fed in pieces.
+
+    Call :meth:`feed` with every piece of the body, then :meth:`close`
+    to get a dictionary of fields. Like with URL-encoded forms, only the
+    first value is kept for each name. Text fields become strings;
+    file fields (those with a ``filename``) become :class:`UploadedFile`.
+
+    Errors, including exceeded limits, are raised from :meth:`close` only.
+    Until then, the rest of the body is just discarded, so that the caller
+    can keep reading it without buffering.
+    """
+
+    def __init__(self, boundary):
+        self.delimiter = b'\r\n--' + boundary
+        # The first delimiter is not preceded by a CRLF, unless there's
+        # a preamble. Pretend there's always an empty one.
+        self._buf = bytearray(b'\r\n')
+        self._state = self._preamble
+        self._fields = {}
+        self._parts = 0
+        self._part = None
+        self._error = None
+
+    def feed(self, data):
+        if self._error is not None:
+            return
+        self._buf += data
+        try:
+            # Each state handler consumes what it can from the buffer,
+            # and returns false when it needs more data.
+            while self._state():
+                pass
+        except (ValueError, LookupError) as exc:     # Also unknown charsets
+            self._error = exc
+            self._buf = bytearray()
+
+    def close(self):
+        if self._error is None and self._state != self._epilogue:
+            self._error = ValueError('multipart body is incomplete')
+        if self._error is not None:
+            raise self._error
+        return self._fields
+
+    def _preamble(self):
+        pos = self._buf.find(self.delimiter)
+        if pos == -1:
+            self._keep_tail()
+            return False
+        del self._buf[:(pos + len(self.delimiter))]
+        self._state = self._after_delimiter
+        return True
+
+    def _after_delimiter(self):
+        if len(self._buf) < 2:
+            return False
+        if self._buf.startswith(b'--'):     # Close delimiter
+            self._buf = bytearray()
+            self._state = self._epilogue
+            return False
+        pos = self._buf.find(b'\r\n')
+        if pos == -1:
+            if len(self._buf) > MAX_HEADERS_SIZE:
+                raise ValueError('malformed multipart delimiter')
+            return False
+        # Anything else before the CRLF is transport padding.
+        del self._buf[:(pos + 2)]
+        self._state = self._headers
+        return True
+
+    def _headers(self):
+        if self._buf.startswith(b'\r\n'):   # No headers at all
+            pos = 0
+        else:
+            pos = self._buf.find(b'\r\n\r\n')
+            if pos == -1:
+                if len(self._buf) > MAX_HEADERS_SIZE:
+                    raise ValueError('multipart headers are too long')
+                return False
+            pos += 2
+        headers = []
+        for line in self._buf[:pos].decode('iso-8859-1').split('\r\n')[:-1]:
+            (name, _, value) = line.partition(':')
+            headers.append((name.strip(), value.strip()))
+        del self._buf[:(pos + 2)]
+        self._start_part(headers)
+        self._state = self._data
+        return True
+
+    def _data(self):
+        pos = self._buf.find(self.delimiter)
+        if pos == -1:
+            self._write(self._buf[:-(len(self.delimiter) - 1)])
+            self._keep_tail()
+            return False
+        self._write(self._buf[:pos])
+        del self._buf[:(pos + len(self.delimiter))]
+        self._finish_part()
+        self._state = self._after_delimiter
+        return True
+
+    def _epilogue(self):
+        self._buf = bytearray()
+        return False
+
+    def _keep_tail(self):
+        # Keep only as much as could be the beginning of a delimiter.
+        del self._buf[:-(len(self.delimiter) - 1)]
+
+    def _start_part(self, headers):
+        self._parts += 1
+        if self._parts > MAX_PARTS:
+            raise ValueError('too many parts in multipart body')
+        lowered = {name.lower(): value for (name, value) in headers}
+        (_, disposition) = parse_header(lowered.get('content-disposition',
+                                                    ''))
+        (content_type, type_params) = parse_header(
+            lowered.get('content-type', 'text/plain'))
+        name = disposition.get('name')
+        if 'filename' in disposition:
+            self._part = (name, UploadedFile(disposition['filename'],
+                                             content_type, headers))
+        else:
+            charset = type_params.get('charset', 'utf-8')
+            self._part = (name, (bytearray(), charset))
+
+    def _write(self, data):
+        if not data:
+            return
+        (_, value) = self._part
+        if isinstance(value, UploadedFile):
+            value.size += len(data)
+            if value.size > MAX_FILE_SIZE:
+                raise ValueError('file in multipart body is too big')
+            value.file.write(data)
+        else:
+            (buf, _) = value
+            buf += data
+            if len(buf) > MAX_FIELD_SIZE:
+                raise ValueError('field in multipart body is too big')
+
+    def _finish_part(self):
+        (name, value) = self._part
+        self._part = None
+        if isinstance(value, UploadedFile):
+            value.file.seek(0)
+        else:
+            (buf, charset) = value
+            value = buf.decode(charset)
+        if name is not None and name not in self._fields:
+            self._fields[name] = value
@@ -0,0 +1,69 @@
+# Generators of synthetic response bodies of any size.
+# Each yields the data in pieces of at most `chunk_size` bytes,
+# so memory use doesn't depend on the total size.
+
+import random
+
+from turq.util.text import force_bytes, lorem_sentence
+
+
+CHUNK_SIZE = 64 * 1024
+
+
+def random_chunks(size, seed=None, chunk_size=CHUNK_SIZE):
+    # The same `seed` gives the same data.
+    rng = random.Random(seed)
+    remaining = size
+    while remaining > 0:
+        n = min(chunk_size, remaining)
+        yield rng.getrandbits(8 * n).to_bytes(n, 'little')
+        remaining -= n
+
+
+def lorem_chunks(size, seed=None, chunk_size=CHUNK_SIZE):
+    rng = random.Random(seed)
+    buf = bytearray()
+    remaining = size
+    while remaining > 0:
+        n = min(chunk_size, remaining)
+        while len(buf) < n:
+            buf += lorem_sentence(rng).encode() + b' '
+        yield bytes(buf[:n])
+        del buf[:n]
+        remaining -= n
+
+
+def repeat_chunks(pattern, size, chunk_size=CHUNK_SIZE):
+    # Not a generator itself, so that a bad `pattern` is reported
+    # right away, rather than when the response is already going out.
+    pattern = force_bytes(pattern, 'utf-8')
+    if not pattern:
+        raise ValueError('cannot repeat an empty pattern')
+    return _repeat_chunks(pattern, size, chunk_size)
+
+
+def _repeat_chunks(pattern, size, chunk_size):
+    # A block of whole patterns, so every chunk begins where a pattern does.
+    block = memoryview(pattern * max(1, chunk_size // len(pattern)))
+    remaining = size
+    while remaining > 0:
+        n = min(len(block), remaining)
+        yield block[:n]
+        remaining -= n
+
+
+def coalesce(pieces, size=CHUNK_SIZE):
+    # Join small pieces into chunks of about `size` bytes,
+    # so that they are not sent one tiny write at a time.
+    buf = []
+    buffered = 0
+    for piece in pieces:
+        piece = force_bytes(piece, 'utf-8')
+        buf.append(piece)
+        buffered += len(piece)
+        if buffered >= size:
+            yield b''.join(buf)
+            buf = []
+            buffered = 0
+    if buf:
+        yield b''.join(buf)
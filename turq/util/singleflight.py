@@ -0,0 +1,71 @@
+import copy
+import threading
+import time
+
+
+class SingleFlight:
+
+    # Coalesces concurrent calls with the same key: the first one
+    # (the leader) does the work, and the others wait for its result
+    # instead of repeating it. If the leader fails with an `Exception`,
+    # every waiter gets the same exception. If it is interrupted instead
+    # (e.g. by `WatchdogTimeout` or `KeyboardInterrupt`), that is none of
+    # the waiters' business: one of them becomes the new leader and tries
+    # again. Waiters give up after `wait_limit` seconds in total.
+
+    def __init__(self, wait_limit=None):
+        self.wait_limit = wait_limit
+        self._calls = {}            # key -> `_Call` in progress
+        self._lock = threading.Lock()
+
+    def run(self, key, func):
+        # Returns ``(result, shared)``, where `shared` is true if `result`
+        # came from another thread. The same `result` object is given
+        # to all callers, so they must not modify it.
+        deadline = (None if self.wait_limit is None
+                    else time.monotonic() + self.wait_limit)
+        while True:
+            with self._lock:
+                call = self._calls.get(key)
+                leader = call is None
+                if leader:
+                    call = self._calls[key] = _Call()
+            if leader:
+                return (self._lead(key, call, func), False)
+            timeout = (None if deadline is None
+                       else max(deadline - time.monotonic(), 0))
+            if not call.done.wait(timeout):
+                raise TimeoutError('gave up waiting for an identical call '
+                                   'after %g seconds' % self.wait_limit)
+            if call.abandoned:
+                continue
+            if call.error is not None:
+                # Raise a copy, so that the waiters don't fight over
+                # the traceback of the one exception object.
+                error = copy.copy(call.error)
+                raise error.with_traceback(call.error.__traceback__)
+            return (call.result, True)
+
+    def _lead(self, key, call, func):
+        try:
+            call.result = func()
+        except Exception as exc:
+            call.error = exc
+            raise
+        except BaseException:
+            call.abandoned = True
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
+
+
+class _Call:
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.abandoned = False      # The leader was interrupted
@@ -25,19 +25,20 @@ LOREM_IPSUM_WORDS = ['a', 'ac', 'accumsan', 'adipiscing', 'aenean', 'aliquam',
 
 
 def force_bytes(x, encoding='iso-8859-1'):
-    if isinstance(x, bytes):
+    if isinstance(x, (bytes, bytearray, memoryview)):
         return x
     else:
         return x.encode(encoding)
 
 
 def lorem_ipsum():
-    return ' '.join(            # sentences
-        ' '.join(               # words
-            random.sample(LOREM_IPSUM_WORDS, random.randint(5, 10))
-        ).capitalize() + '.'
-        for _ in range(random.randint(5, 10))
-    )
+    return ' '.join(lorem_sentence() for _ in range(random.randint(5, 10)))
+
+
+def lorem_sentence(rng=random):
+    return ' '.join(
+        rng.sample(LOREM_IPSUM_WORDS, rng.randint(5, 10))
+    ).capitalize() + '.'
 
 
 def ellipsize(s, max_length=60):
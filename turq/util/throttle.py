@@ -0,0 +1,56 @@
+import threading
+import time
+
+
+class TokenBucket:
+
+    # Paces writes to `rate` bytes per second, allowing bursts of up to
+    # `burst` bytes. One bucket can be shared by several connections
+    # (it's thread-safe), in which case they split the rate between them.
+    # The lock is only held for bookkeeping, never while waiting.
+
+    def __init__(self, rate, burst=None):
+        if rate <= 0:
+            raise ValueError('throttle rate must be positive')
+        self.rate = rate
+        # By default, allow 50 ms worth of data at once: small enough
+        # to keep pacing smooth, large enough to not flood the connection
+        # with tiny writes at high rates.
+        self.burst = burst or max(1, int(rate / 20))
+        self._tokens = self.burst
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def consume(self, n):
+        # The balance may go negative; then we wait until it's paid back.
+        # This keeps the long-term rate exact regardless of write sizes.
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst,
+                               self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            self._tokens -= n
+            wait = -self._tokens / self.rate
+        if wait > 0:
+            time.sleep(wait)
+
+    def pieces(self, data):
+        # Split `data` into pieces that can be sent without exceeding
+        # the burst, consuming tokens for each one before it is yielded.
+        view = memoryview(data)
+        for i in range(0, len(view), self.burst):
+            piece = view[i:(i + self.burst)]
+            self.consume(len(piece))
+            yield piece
+
+
+_shared = {}
+_shared_lock = threading.Lock()
+
+
+def shared_bucket(rate):
+    # A process-wide bucket for the given rate.
+    with _shared_lock:
+        if rate not in _shared:
+            _shared[rate] = TokenBucket(rate)
+        return _shared[rate]
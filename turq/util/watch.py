@@ -0,0 +1,40 @@
+import logging
+import os
+import threading
+import time
+
+
+def watch_file(path, callback, interval=1):
+    """Call `callback` in a background thread whenever `path` changes.
+
+    This simply polls the file's metadata every `interval` seconds.
+    One :func:`os.stat` per second is too cheap to be worth
+    platform-specific notification APIs.
+    """
+    thread = threading.Thread(target=_poll, args=(path, callback, interval),
+                              name='watch %s' % path, daemon=True)
+    thread.start()
+    return thread
+
+
+def _poll(path, callback, interval):
+    last = _signature(path)
+    while True:
+        time.sleep(interval)
+        current = _signature(path)
+        if current != last:
+            last = current
+            if current is not None:         # The file may be mid-replace
+                try:
+                    callback(path)
+                except Exception:
+                    logging.getLogger('turq').exception(
+                        'error while reloading %s', path)
+
+
+def _signature(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_ino, st.st_size, st.st_mtime_ns)
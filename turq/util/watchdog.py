@@ -0,0 +1,96 @@
+# Aborts code that runs for too long, such as rules with an infinite loop,
+# by raising an exception asynchronously in the thread that runs it.
+# Only Python code can be interrupted this way: a thread that is blocked
+# in a system call (e.g. `time.sleep`) gets the exception when it returns.
+
+import contextlib
+import threading
+import time
+
+
+CHECK_INTERVAL = 0.1
+
+
+class WatchdogTimeout(BaseException):
+
+    # A `BaseException`, so that ``except Exception`` in the guarded code
+    # can't swallow it.
+    pass
+
+
+class Watchdog:
+
+    def __init__(self, cpu_limit=None, time_limit=None):
+        if cpu_limit and not hasattr(time, 'pthread_getcpuclockid'):
+            raise ValueError('CPU time limit is not supported '
+                             'on this platform')
+        self.cpu_limit = cpu_limit
+        self.time_limit = time_limit
+        self._guarded = {}          # thread ident -> `_Guarded`
+        self._lock = threading.Lock()
+        threading.Thread(target=self._watch, daemon=True).start()
+
+    @contextlib.contextmanager
+    def guard(self):
+        # Everything here must be as cheap as possible,
+        # because it's done for every request.
+        ident = threading.get_ident()
+        guarded = _Guarded(self, ident)
+        with self._lock:
+            self._guarded[ident] = guarded
+        try:
+            yield
+        except WatchdogTimeout as exc:
+            # Only the class can be raised asynchronously, so add
+            # the message now.
+            exc.args = exc.args or (guarded.reason,)
+            raise
+        finally:
+            with self._lock:
+                del self._guarded[ident]
+            if guarded.fired:
+                # The exception may still be pending if the guarded code
+                # finished before it was delivered. Cancel it, so that it
+                # doesn't hit some unsuspecting code later.
+                _set_async_exc(ident, None)
+
+    def _watch(self):
+        while True:
+            time.sleep(CHECK_INTERVAL)
+            with self._lock:
+                for guarded in self._guarded.values():
+                    if not guarded.fired:
+                        guarded.reason = guarded.over_limit()
+                        if guarded.reason:
+                            guarded.fired = True
+                            _set_async_exc(guarded.ident, WatchdogTimeout)
+
+
+class _Guarded:
+
+    def __init__(self, watchdog, ident):
+        self.watchdog = watchdog
+        self.ident = ident
+        self.fired = False
+        self.reason = None
+        self.started = time.monotonic()
+        if watchdog.cpu_limit:
+            self.cpu_clock = time.pthread_getcpuclockid(ident)
+            self.cpu_started = time.clock_gettime(self.cpu_clock)
+
+    def over_limit(self):
+        time_limit = self.watchdog.time_limit
+        if time_limit and time.monotonic() - self.started > time_limit:
+            return 'exceeded time limit of %g seconds' % time_limit
+        cpu_limit = self.watchdog.cpu_limit
+        if cpu_limit and (time.clock_gettime(self.cpu_clock) -
+                          self.cpu_started > cpu_limit):
+            return 'exceeded CPU time limit of %g seconds' % cpu_limit
+        return None
+
+
+def _set_async_exc(ident, exc):
+    import ctypes
+    ctypes.pythonapi.PyThreadState_SetAsyncExc(
+        ctypes.c_ulong(ident),
+        None if exc is None else ctypes.py_object(exc))